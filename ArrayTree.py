@@ -0,0 +1,373 @@
+import random
+import numpy as np
+import Othello as o
+from Board import WIN, DRAW, LOSS
+from GameState import GameState
+
+"""
+Struct-of-arrays tree store for MonteCarlo. Instead of one Board.Node object per node, every node is a row
+index into preallocated NumPy arrays, which grow by doubling when full.
+
+Children of a node are one contiguous block [first_child, first_child + child_count). The block is allocated
+the first time the node is expanded, with one slot per legal move (or a single pass slot) in random order.
+Expanding takes the next slot in the block, so the first `expanded` slots are the children that exist and the
+rest are the untried moves. This keeps the random untried-move choice of Board.Node.make_child without
+storing a move list per node.
+"""
+
+# Field name -> dtype. Every field is one array with a row per node.
+FIELDS = {
+    'white': np.uint64,
+    'black': np.uint64,
+    'turn_count': np.int16,
+    'move': np.int8, # Move that reached the node, -1 for a pass (and the root)
+    'parent': np.int32, # -1 for the root
+    'first_child': np.int32, # -1 until the node is first expanded
+    'child_count': np.int8, # Slots in the child block: number of legal moves, 1 for a pass
+    'expanded': np.int8, # Slots that have been turned into nodes
+    'visits': np.int32,
+    'score': np.float64,
+    'proven': np.int8, # Board.WIN / DRAW / LOSS (view of the player who moved in), UNPROVEN until known
+    'proven_children': np.int8, # Children whose result is proven
+}
+
+UNPROVEN = 2
+
+BYTES_PER_NODE = sum(np.dtype(dtype).itemsize for dtype in FIELDS.values())
+
+
+class ArrayTree:
+
+    def __init__(self, state=None, capacity=1024):
+        """
+        :param state: GameState of the root, the start position if None
+        :param capacity: Rows allocated up front. The arrays double in size whenever they run out.
+        """
+        self.init_arrays(capacity)
+        self.add_root(GameState() if state is None else state)
+
+    @staticmethod
+    def empty(capacity):
+        # Tree without a root, filled in by subtree / load
+        tree = ArrayTree.__new__(ArrayTree)
+        tree.init_arrays(capacity)
+        return tree
+
+    def init_arrays(self, capacity):
+        self.capacity = 0
+        self.size = 0 # Rows in use, unexpanded child slots included
+        for name, dtype in FIELDS.items():
+            setattr(self, name, np.zeros(0, dtype=dtype))
+        self.reserve(capacity)
+
+    def reserve(self, capacity):
+        # Grow every array to at least capacity rows
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity)
+
+        for name, dtype in FIELDS.items():
+            array = np.zeros(capacity, dtype=dtype)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def allocate(self, count):
+        # Reserve `count` new rows, returns the index of the first one
+        start = self.size
+        self.reserve(start + count)
+        self.size += count
+
+        self.first_child[start:self.size] = -1
+        self.proven[start:self.size] = UNPROVEN
+        return start
+
+    def add_root(self, state):
+        root = self.allocate(1)
+        self.set_state(root, state)
+        self.move[root] = -1
+        self.parent[root] = -1
+        self.visits[root] = 1 # Same as MonteCarlo.create_root
+        return root
+
+    def set_state(self, i, state):
+        self.white[i] = state.white
+        self.black[i] = state.black
+        self.turn_count[i] = state.turn_count
+
+    def state(self, i):
+        return GameState(int(self.white[i]), int(self.black[i]), int(self.turn_count[i]))
+
+    def black_to_play(self, i):
+        return self.turn_count[i] % 2 == 0
+
+    def allocate_children(self, i):
+        # Child block for node i: one slot per legal move in random order, or a single pass slot
+        state = self.state(i)
+        moves = list(o.iterate_bits(state.moves)) or [-1]
+        random.shuffle(moves)
+
+        start = self.allocate(len(moves))
+        self.move[start:self.size] = moves
+        self.parent[start:self.size] = i
+
+        self.first_child[i] = start
+        self.child_count[i] = len(moves)
+
+    def is_explored(self, i):
+        return self.first_child[i] != -1 and self.expanded[i] == self.child_count[i]
+
+    def expand(self, i):
+        """
+        Turn the next untried move of node i into a child node.
+        :return: Index of the child
+        """
+        if self.first_child[i] == -1:
+            self.allocate_children(i)
+
+        child = self.first_child[i] + self.expanded[i]
+        self.expanded[i] += 1
+
+        state = self.state(i).play(int(self.move[child]))
+        self.set_state(child, state)
+        if state.moves == 0 and state.is_terminal():
+            self.prove(child, state.winner())
+        return int(child)
+
+    def prove(self, i, result):
+        # Board.Node.prove: result in white's view
+        self.proven[i] = result if self.black_to_play(i) else -result
+
+    def result(self, i):
+        # Proven result of node i in white's view
+        return int(self.proven[i]) if self.black_to_play(i) else -int(self.proven[i])
+
+    def update_proven(self, i, child):
+        """
+        Minimax step for node i once its child is proven, like Board.Node.update_proven.
+        :return: True if node i is newly proven
+        """
+        if self.proven[i] != UNPROVEN:
+            return False
+
+        self.proven_children[i] += 1
+        if self.proven[child] == WIN:
+            self.proven[i] = LOSS
+        elif self.expanded[i] == self.child_count[i] and self.proven_children[i] == self.child_count[i]:
+            start = int(self.first_child[i])
+            self.proven[i] = -self.proven[start:start + int(self.child_count[i])].max()
+        return self.proven[i] != UNPROVEN
+
+    def children(self, i):
+        # Indices of the children that exist
+        start = int(self.first_child[i])
+        return range(start, start + int(self.expanded[i])) if start != -1 else range(0)
+
+    def untried_moves(self, i):
+        # Bitboard of the moves without a child yet, pass is o.PASS_MASK. Same as Board.Node.available_moves
+        if self.first_child[i] == -1:
+            moves = self.state(i).moves
+            return moves if moves else o.PASS_MASK
+
+        start = int(self.first_child[i])
+        moves = 0
+        for move in self.move[start + int(self.expanded[i]):start + int(self.child_count[i])]:
+            moves |= o.SQUARE_MASKS[int(move)]
+        return moves
+
+    def child_with_move(self, i, move):
+        """
+        Child of node i reached by move, expanded if needed (Board.Node.make_child with a given move).
+        :return: Index of the child
+        """
+        if self.first_child[i] == -1:
+            self.allocate_children(i)
+
+        start, expanded = int(self.first_child[i]), int(self.expanded[i])
+        slot = start + int(np.flatnonzero(self.move[start:start + int(self.child_count[i])] == move)[0])
+        if slot < start + expanded:
+            return slot
+
+        # Swap the slot into the untried position that is expanded next
+        next_slot = start + expanded
+        self.move[slot], self.move[next_slot] = self.move[next_slot], self.move[slot]
+        return self.expand(i)
+
+    def best_child(self, i):
+        # Child with the best mean score, ties broken at random (Board.Node.compute_best_score)
+        start, end = int(self.first_child[i]), int(self.first_child[i]) + int(self.expanded[i])
+        means = self.score[start:end] / self.visits[start:end]
+        if self.proven_children[i]:
+            # Proven wins above every estimate, proven losses below, proven draws at their exact value
+            proven = self.proven[start:end].astype(np.float64)
+            means = np.where(proven == UNPROVEN, means, 2 * proven + np.where(proven == DRAW, 0, means))
+        return start + int(random.choice(np.flatnonzero(means == means.max())))
+
+    def subtree(self, i, min_visits=0):
+        """
+        Copy of the subtree under node i as a new, compact tree with i as its root.
+        Used when the search moves on to a child, so the rest of the old tree can be freed.
+        :param min_visits: Nodes (other than i) with fewer visits are copied without their child blocks (see prune)
+        """
+        tree = ArrayTree.empty(max(1024, self.size))
+
+        root = tree.allocate(1)
+        for name in FIELDS:
+            getattr(tree, name)[root] = getattr(self, name)[i]
+        tree.parent[root] = -1
+
+        # One child block at a time: (old index, new index) of nodes whose block still has to be copied
+        pending = [(i, root)]
+        while pending:
+            old, new = pending.pop()
+            if self.first_child[old] == -1 or (old != i and self.visits[old] < min_visits):
+                tree.first_child[new] = -1
+                tree.child_count[new] = tree.expanded[new] = tree.proven_children[new] = 0
+                continue
+
+            start, count = int(self.first_child[old]), int(self.child_count[old])
+            new_start = tree.allocate(count)
+            for name in FIELDS:
+                getattr(tree, name)[new_start:new_start + count] = getattr(self, name)[start:start + count]
+            tree.parent[new_start:new_start + count] = new
+            tree.first_child[new] = new_start
+
+            pending.extend((start + k, new_start + k) for k in range(int(self.expanded[old])))
+
+        return tree
+
+    def prune(self, target):
+        """
+        Compact copy of the tree that keeps at most target nodes: the child blocks of the least visited nodes are
+        dropped, and those nodes are expanded again if the search comes back to them (see TreeMemory.prune).
+        """
+        internal = self.expanded[:self.size] > 0
+        internal[0] = False # The root always keeps its children
+        visits = self.visits[:self.size][internal]
+        order = np.argsort(-visits, kind='stable')
+
+        kept = 1 + int(self.expanded[0]) + np.cumsum(self.expanded[:self.size][internal][order])
+        over = np.flatnonzero(kept > target)
+        return self.subtree(0, int(visits[order[over[0]]]) + 1 if len(over) else 0)
+
+    def node_count(self):
+        # Nodes that exist, without the untried child slots
+        return 1 + int(self.expanded[:self.size].sum())
+
+    def memory_usage(self):
+        # Bytes held by the arrays
+        return sum(getattr(self, name).nbytes for name in FIELDS)
+
+    def save(self, path):
+        np.savez(path, **{name: getattr(self, name)[:self.size] for name in FIELDS})
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        tree = ArrayTree.empty(len(data['parent']))
+        tree.size = len(data['parent'])
+        for name in FIELDS:
+            getattr(tree, name)[:tree.size] = data[name]
+        return tree
+
+
+class ArrayNode:
+    """
+    Handle to one node of an ArrayTree with the interface of Board.Node that MonteCarlo and Play use
+    (children, make_child, move, visits, score, state, ...), so both tree stores can be passed around the same way.
+    """
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index=0):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def parent(self):
+        parent = int(self.tree.parent[self.index])
+        return ArrayNode(self.tree, parent) if parent != -1 else None
+
+    @property
+    def children(self):
+        return [ArrayNode(self.tree, child) for child in self.tree.children(self.index)]
+
+    @property
+    def move(self):
+        return int(self.tree.move[self.index])
+
+    @property
+    def state(self):
+        return self.tree.state(self.index)
+
+    @property
+    def visits(self):
+        return int(self.tree.visits[self.index])
+
+    @visits.setter
+    def visits(self, visits):
+        self.tree.visits[self.index] = visits
+
+    @property
+    def score(self):
+        return float(self.tree.score[self.index])
+
+    @score.setter
+    def score(self, score):
+        self.tree.score[self.index] = score
+
+    @property
+    def proven(self):
+        proven = int(self.tree.proven[self.index])
+        return proven if proven != UNPROVEN else None
+
+    @proven.setter
+    def proven(self, proven):
+        self.tree.proven[self.index] = UNPROVEN if proven is None else proven
+
+    @property
+    def available_moves(self):
+        return self.tree.untried_moves(self.index)
+
+    def is_explored(self):
+        return self.tree.is_explored(self.index)
+
+    def add_result(self, score, visits=1):
+        self.tree.score[self.index] += score
+        self.tree.visits[self.index] += visits
+
+    def update_proven(self, child):
+        return self.tree.update_proven(self.index, child.index)
+
+    def make_child(self, move=None):
+        if move is None:
+            return ArrayNode(self.tree, self.tree.expand(self.index))
+        return ArrayNode(self.tree, self.tree.child_with_move(self.index, move))
+
+    def compute_best_score(self):
+        node = ArrayNode(self.tree, self.tree.best_child(self.index))
+        return node, node.move
+
+
+if __name__ == '__main__':
+    import os
+    import time
+    import tempfile
+    import MonteCarlo as mc
+    from Endgame import EndgameSolver
+
+    # Same search on both tree stores
+    for array_tree in (False, True):
+        start = time.perf_counter()
+        node, move = mc.monte_carlo_tree_search(None, 2000, 2 ** .5, 1, None, EndgameSolver(0, 0), array_tree)
+        seconds = time.perf_counter() - start
+        print(f'{"ArrayTree" if array_tree else "Board.Node"}: {2000 / seconds:.0f} iterations/s, move {o.move_name(move)}')
+
+    tree = node.tree
+    print(f'{tree.node_count()} nodes in {tree.size} rows, {tree.memory_usage()} bytes allocated '
+          f'({BYTES_PER_NODE} bytes per row)')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tree.npz')
+        tree.save(path)
+        print(f'Saved and reloaded: {ArrayTree.load(path).node_count()} nodes')
+    print(f'Subtree of the chosen move: {tree.subtree(node.index).node_count()} nodes')
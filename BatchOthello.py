@@ -0,0 +1,229 @@
+import numpy as np
+import Othello as o
+
+"""
+Batched counterparts of the bitboard functions in Othello.py.
+Every function takes uint64 NumPy arrays of player / opponent boards (any shape, broadcast together)
+and works on the whole batch at once, so the Python overhead is paid per call instead of per position.
+
+Moves are passed around as single-bit uint64 masks (0 = pass) instead of indices, which is what the
+shift-and-mask kernels need anyway. Use index_to_bit / bit_to_index to convert.
+"""
+
+FULL = np.uint64(o.FULL)
+NOT_A_FILE = np.uint64(o.NOT_A_FILE)
+NOT_H_FILE = np.uint64(o.NOT_H_FILE)
+
+# (shift, edge mask) pairs. Same directions as Othello.shift_boards
+LEFT_SHIFTS = ((np.uint64(1), NOT_A_FILE), (np.uint64(7), NOT_H_FILE), (np.uint64(8), FULL), (np.uint64(9), NOT_A_FILE))
+RIGHT_SHIFTS = ((np.uint64(1), NOT_H_FILE), (np.uint64(7), NOT_A_FILE), (np.uint64(8), FULL), (np.uint64(9), NOT_H_FILE))
+
+SQUARE_BITS = np.array(o.SQUARE_MASKS[:64] + [0], dtype=np.uint64) # Index 64 / -1 (pass) -> no bit
+
+
+def to_boards(boards):
+    # Python ints (or lists of them) -> uint64 array
+    return np.asarray(boards, dtype=np.uint64)
+
+def index_to_bit(move_dex):
+    return SQUARE_BITS[np.asarray(move_dex)]
+
+def bit_to_index(bits):
+    # Single-bit masks -> square index. Empty masks (pass) become -1.
+    bits = to_boards(bits)
+    dex = np.full(bits.shape, -1, dtype=np.int64)
+    nonzero = bits != 0
+    dex[nonzero] = np.log2(bits[nonzero].astype(np.float64)).astype(np.int64) # Exact for powers of two
+    return dex
+
+
+def _shift(b, shift, left):
+    return b << shift if left else b >> shift
+
+def gen_moves(player, opponent):
+    """
+    Batched advanced_gen_moves. Fills from the player's pieces through runs of opponent pieces in all 8 directions.
+    :return: Bitboards of the legal moves for player.
+    """
+    player, opponent = to_boards(player), to_boards(opponent)
+    empty = ~(player | opponent)
+    moves = np.zeros(np.broadcast(player, opponent).shape, dtype=np.uint64)
+
+    for shifts, left in ((LEFT_SHIFTS, True), (RIGHT_SHIFTS, False)):
+        for shift, mask in shifts:
+            pro = opponent & mask
+            run = _shift(player, shift, left) & pro
+            for _ in range(5): # Longest possible run is 6 pieces
+                run |= _shift(run, shift, left) & pro
+            moves |= _shift(run, shift, left) & mask & empty
+
+    return moves
+
+def flip_masks(move_bits, player, opponent):
+    """
+    Batched Othello.flip_mask.
+    :param move_bits: Single-bit masks of the move to play per position. 0 = pass -> no flips.
+    :return: Bitboards of the opponent pieces that get flipped.
+    """
+    move_bits, player, opponent = to_boards(move_bits), to_boards(player), to_boards(opponent)
+    flips = np.zeros(np.broadcast(move_bits, player, opponent).shape, dtype=np.uint64)
+    zero = np.uint64(0)
+
+    for shifts, left in ((LEFT_SHIFTS, True), (RIGHT_SHIFTS, False)):
+        for shift, mask in shifts:
+            pro = opponent & mask
+            run = _shift(move_bits, shift, left) & pro
+            for _ in range(5):
+                run |= _shift(run, shift, left) & pro
+            bracketed = (_shift(run, shift, left) & mask & player) != zero
+            flips |= np.where(bracketed, run, zero)
+
+    return flips
+
+def update_boards(move_bits, player, opponent):
+    """
+    Batched Othello.update_board. Positions with a 0 move bit (pass) come back unchanged.
+    :return: (player, opponent) after the move
+    """
+    move_bits, player, opponent = to_boards(move_bits), to_boards(player), to_boards(opponent)
+    flips = flip_masks(move_bits, player, opponent)
+    return player | flips | move_bits, opponent & ~flips
+
+
+def unpack_boards(boards):
+    """
+    Unpack bitboards into 0 / 1 planes, square 8*row + column at [row, column].
+    :param boards: Boards of any shape S
+    :return: uint8 array of shape S + (8, 8)
+    """
+    boards = to_boards(boards)
+    shape = boards.shape
+    rows = np.ascontiguousarray(boards, dtype='<u8').view(np.uint8).reshape(shape + (8,)) # Little endian: byte i = row i
+    return np.unpackbits(rows, axis=-1, bitorder='little').reshape(shape + (8, 8))
+
+
+def popcount(b):
+    b = to_boards(b)
+    if hasattr(np, 'bitwise_count'): # NumPy >= 2.0
+        return np.bitwise_count(b).astype(np.int64)
+
+    # SWAR popcount for older NumPy versions
+    b = b - ((b >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    b = (b & np.uint64(0x3333333333333333)) + ((b >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    b = (b + (b >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((b * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+def is_terminal(player, opponent):
+    # Neither side can move -> game over
+    zero = np.uint64(0)
+    return (gen_moves(player, opponent) == zero) & (gen_moves(opponent, player) == zero)
+
+def determine_winner(white, black):
+    # Batched Othello.determine_winner: 1 if white wins, -1 if black wins, 0 for a draw
+    return np.sign(popcount(white) - popcount(black))
+
+
+RNG = np.random.default_rng()
+
+def random_bits(moves, rng=None):
+    """
+    Batched Othello.random_bit: a uniformly random set bit of every board, returned as a single-bit mask.
+    Empty boards give 0 (pass).
+    """
+    rng = RNG if rng is None else rng
+    moves = to_boards(moves)
+
+    # Pick k in [0, count) per board, then clear the k lowest set bits
+    k = (rng.random(moves.shape) * popcount(moves)).astype(np.int64)
+    b = moves.copy()
+    for i in range(int(k.max(initial=0))):
+        b = np.where(k > i, b & (b - np.uint64(1)), b)
+
+    return b & (~b + np.uint64(1)) # Isolate lowest set bit
+
+def random_games(white, black, turn_count, num_games=None, rng=None):
+    """
+    Play random games to the end for a whole batch of positions in lockstep (batched MonteCarlo.random_game).
+    Finished games (two passes in a row) are dropped from the batch so the rest keep running on smaller arrays.
+    :param num_games: If given, every position is broadcast to this many games (e.g. many playouts of one leaf)
+    :return: int array of results. -1 if black won, 1 if white won, 0 if draw
+    """
+    rng = RNG if rng is None else rng
+    shape = np.broadcast(to_boards(white), to_boards(black), np.asarray(turn_count)).shape
+    if num_games is not None:
+        shape = np.broadcast_shapes(shape, (num_games,))
+
+    white = np.broadcast_to(to_boards(white), shape).ravel()
+    black = np.broadcast_to(to_boards(black), shape).ravel()
+    black_to_play = np.broadcast_to(np.asarray(turn_count) % 2 == 0, shape).ravel()
+
+    player = np.where(black_to_play, black, white)
+    opponent = np.where(black_to_play, white, black)
+    last_turn_pass = np.zeros(player.shape, dtype=bool)
+
+    results = np.zeros(player.shape, dtype=np.int64)
+    active = np.arange(player.size)
+
+    while active.size:
+        moves = gen_moves(player, opponent)
+        passed = moves == np.uint64(0)
+
+        finished = passed & last_turn_pass
+        if finished.any():
+            # Game complete! Parse who is black for every finished game
+            fin_white = np.where(black_to_play[finished], opponent[finished], player[finished])
+            fin_black = np.where(black_to_play[finished], player[finished], opponent[finished])
+            results[active[finished]] = determine_winner(fin_white, fin_black)
+
+            keep = ~finished
+            active, player, opponent, moves, passed, black_to_play = \
+                active[keep], player[keep], opponent[keep], moves[keep], passed[keep], black_to_play[keep]
+
+        # Passing games get a 0 move bit, which leaves their boards unchanged
+        player, opponent = update_boards(random_bits(moves, rng), player, opponent)
+
+        # Flips boards to current turn
+        player, opponent = opponent, player
+        black_to_play = ~black_to_play
+        last_turn_pass = passed
+
+    return results.reshape(shape)
+
+
+def compare_with_othello(num_positions=100000, seed=None):
+    """
+    Differential check of the batched kernels against the scalar functions in Othello.py on random positions.
+    :return: Number of positions compared. Raises AssertionError on the first mismatch.
+    """
+    rng = np.random.default_rng(seed)
+    occupied = rng.integers(0, 2**64, num_positions, dtype=np.uint64, endpoint=False) | \
+               rng.integers(0, 2**64, num_positions, dtype=np.uint64, endpoint=False)
+    player = occupied & rng.integers(0, 2**64, num_positions, dtype=np.uint64, endpoint=False)
+    opponent = occupied & ~player
+
+    moves = gen_moves(player, opponent)
+    terminal = is_terminal(player, opponent)
+    counts = popcount(player)
+
+    # Play the lowest legal move (or pass) everywhere
+    move_bits = moves & (~moves + np.uint64(1))
+    new_player, new_opponent = update_boards(move_bits, player, opponent)
+    move_dex = bit_to_index(move_bits)
+
+    for i in range(num_positions):
+        p, q = int(player[i]), int(opponent[i])
+        assert int(moves[i]) == o.advanced_gen_moves(p, q), f'gen_moves mismatch: player {p}, opponent {q}'
+        assert bool(terminal[i]) == (o.advanced_gen_moves(q, p) == 0 and int(moves[i]) == 0)
+        assert int(counts[i]) == int.bit_count(p)
+
+        if move_dex[i] != -1:
+            expected = o.update_board(int(move_dex[i]), p, q)
+        else:
+            expected = p, q
+        assert (int(new_player[i]), int(new_opponent[i])) == expected, f'update_boards mismatch: player {p}, opponent {q}'
+
+    return num_positions
+
+
+if __name__ == '__main__':
+    print(f'BatchOthello matches Othello on {compare_with_othello(seed=0)} positions')
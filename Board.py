@@ -1,61 +1,152 @@
 import Othello as o
 import random
 import math
+from TranspositionTable import Entry
+from GameState import GameState
+
+# Proven game results (MCTS-Solver), from the view of the player who moved into the node like the scores
+WIN, DRAW, LOSS = 1, 0, -1
+
+def random_argmax(values):
+    # Index of the largest value in a list, ties broken at random
+    best = max(values)
+    if values.count(best) == 1:
+        return values.index(best)
+    return random.choice([i for i, value in enumerate(values) if value == best])
 
 class Node:
 
-    def __init__(self, parent=None, white=34628173824, black=68853694464, move = -1, turn_count=0):
+    def __init__(self, parent=None, state=None, move = -1, table=None):
         # Properties relevant to a node of a monte carlo tree
         self.parent = parent
         self.children = []
 
-        self.visits = 0
-        self.score = 0
-
         # Properties of the current Othello game state
-        self.white = white
-        self.black = black
+        self.state = GameState() if state is None else state
         self.move = move
-        self.turn_count = turn_count
 
-        # Note: When true, black is to play. When false, white is to play
-        self.to_play = turn_count % 2 == 0
+        # Visits + score live in an Entry. With a transposition table, nodes of the same position share it.
+        # Roots and nodes reached by a pass keep their own: after two passes the position repeats its grandparent.
+        self.table = table
+        self.stats = Entry()
+        if table is not None:
+            key = self.state.key # Known from here on, so the children's hashes are updated incrementally
+            if move != -1:
+                self.stats = table.lookup(key)
+
+        # Bitboard of the moves that do not have a child yet. Bit 64 (o.PASS_MASK) is the pass token.
+        self.available_moves = self.state.moves
+        if self.available_moves == 0:
+            self.available_moves = o.PASS_MASK # Pass token
+
+        # Visits / score of every child as seen from this node, in the order of self.children, so UCT runs over
+        # two flat lists instead of calling into every child. Transpositions share the children's Entry,
+        # but these count only the results that went through this node.
+        self.child_visits = []
+        self.child_scores = []
+        self.index = 0 # Position in parent.children
+        self.virtual_visits = 0 # Virtual loss of the leaf parallel rollouts in flight through this node, not in the Entry
+
+        # WIN / DRAW / LOSS once the result with perfect play is known, None until then. Selection skips proven children.
+        self.proven = None
+        self.proven_children = 0
+        if self.available_moves == o.PASS_MASK and self.state.is_terminal():
+            self.prove(self.state.winner())
+
+    @property
+    def visits(self):
+        return self.stats.visits
+
+    @visits.setter
+    def visits(self, visits):
+        self.stats.visits = visits
 
-        if self.to_play:
-            self.available_moves = o.get_valid_move_list(black, white)
-        else:
-            self.available_moves = o.get_valid_move_list(white, black)
+    @property
+    def score(self):
+        return self.stats.score
 
-        if len(self.available_moves) == 0:
-            self.available_moves.append(-1) # Pass token
+    @score.setter
+    def score(self, score):
+        self.stats.score = score
 
     def is_explored(self):
-        return len(self.available_moves) == 0
+        return self.available_moves == 0
 
-    def make_child(self, move = None):
-        if move is None: move = random.choice(self.available_moves)
+    def add_result(self, score, visits = 1):
+        # Add to this node's statistics, and to the parent's arrays for this child
+        self.stats.score += score
+        self.stats.visits += visits
+        if self.parent is not None:
+            self.parent.child_scores[self.index] += score
+            self.parent.child_visits[self.index] += visits
+
+    def prove(self, result):
+        # Mark the node as proven from a game result in white's view (1 white wins, -1 black wins, 0 draw)
+        self.proven = result if self.state.black_to_play else -result
+
+    def result(self):
+        # Proven result in white's view, the inverse of prove
+        return self.proven if self.state.black_to_play else -self.proven
+
+    def update_proven(self, child):
+        '''
+        Minimax step once child is proven. The player to move here picks the best child for themselves, so a single
+        proven win proves this node lost for the player who moved into it. Otherwise it is only proven once
+        every move has a proven child, as the worst of their results.
+        :return: True if this node is now proven
+        '''
+        self.proven_children += 1
+        if child.proven == WIN:
+            self.proven = LOSS
+        elif self.available_moves == 0 and self.proven_children == len(self.children):
+            self.proven = -max(child.proven for child in self.children)
+        return self.proven is not None
 
-        if move != -1:
-            if self.to_play:
-                new_black, new_white = o.update_board(move, self.black, self.white)
-            else:
-                new_white, new_black = o.update_board(move, self.white, self.black)
-        else:
-            # Pass -> boards unchanged
-            new_black, new_white = self.black, self.white
+    def clear_children(self):
+        # Drop the subtree under this node (TreeMemory.prune). Its own statistics stay, and its moves are
+        # expanded again if the search comes back to it.
+        for child in self.children:
+            child.parent = None
+        self.children = []
+        self.child_visits = []
+        self.child_scores = []
+        self.proven_children = 0
+        self.available_moves = self.state.moves or o.PASS_MASK
+
+    def make_child(self, move = None):
+        if move is None:
+            move = o.random_bit(self.available_moves)
+            if move == 64: move = -1
 
-        self.available_moves.remove(move)
+        self.available_moves &= ~o.SQUARE_MASKS[move]
 
-        child = Node(self, new_white, new_black, move, self.turn_count + 1)
+        child = Node(self, self.state.play(move), move, self.table)
+        child.index = len(self.children)
         self.children.append(child)
+        self.child_visits.append(0)
+        self.child_scores.append(0)
 
         return child
 
     def compute_UCT(self, c):
         return self.score / self.visits + c * math.sqrt(math.log(self.parent.visits)/self.visits)
 
+    def select_child(self, c):
+        # compute_UCT for all children in one pass over the lists. Only called once every move has a child.
+        explore = c * math.sqrt(math.log(self.visits + self.virtual_visits))
+        uct = [score / visits + explore / math.sqrt(visits) for score, visits in zip(self.child_scores, self.child_visits)]
+        if self.proven_children:
+            for i, child in enumerate(self.children):
+                if child.proven is not None:
+                    uct[i] = -math.inf
+        return self.children[random_argmax(uct)]
+
     def compute_best_score(self):
-        scores = [(node, node.score / node.visits) for node in self.children]
-        max_score = max([child[1] for child in scores])
-        node = random.choice([child for child in scores if child[1] == max_score])[0]
+        scores = [score / visits for score, visits in zip(self.child_scores, self.child_visits)]
+        if self.proven_children:
+            # Proven wins above every estimate, proven losses below, proven draws at their exact value
+            for i, child in enumerate(self.children):
+                if child.proven is not None:
+                    scores[i] = 2 * child.proven + (scores[i] if child.proven != DRAW else 0)
+        node = self.children[random_argmax(scores)]
         return node, node.move
\ No newline at end of file
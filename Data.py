@@ -3,6 +3,7 @@ import torch
 import pandas as pd
 from torch.utils.data import Dataset, DataLoader
 import Play as p
+from NeuralMonteCarlo import board_state_to_tensor
 import random
 from tqdm import tqdm
 
@@ -60,10 +61,10 @@ class OthelloGames(Dataset):
             else:
                 player, opponent = white, black
 
-            possible_moves = Othello.get_valid_move_list(player, opponent)
+            possible_moves = Othello.advanced_gen_moves(player, opponent)
 
             # If move not valid, pass
-            if moves[move_dex] not in possible_moves:
+            if not possible_moves & Othello.SQUARE_MASKS[moves[move_dex]]:
                 turn_count += 1
 
             # Else, update board states
@@ -83,22 +84,7 @@ class OthelloGames(Dataset):
         # Layer 0 - Player
         # Layer 1 - Opponent
         # Layer 2 - Valid Moves for Player (to help guide)
-        board = torch.zeros((3,8,8))
-
-        if turn_count % 2 == 0:
-            player, opponent = black, white
-        else:
-            player, opponent = white, black
-        move_board = Othello.advanced_gen_moves(player, opponent)
-
-        for i in range(8):
-            for j in range(8):
-                if Othello.read_bit(player, i*8+j):
-                    board[0, i, j] = 1
-                elif Othello.read_bit(opponent, i*8+j):
-                    board[1, i, j] = 1
-                elif Othello.read_bit(move_board, i*8+j):
-                    board[2, i, j] = 1
+        board = board_state_to_tensor(white, black, turn_count)[0]
 
         return torch.tensor(win_condition, dtype=torch.float32), board
 
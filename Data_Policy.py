@@ -3,6 +3,7 @@ import torch
 import pandas as pd
 from torch.utils.data import Dataset, DataLoader
 import Play as p
+from NeuralMonteCarlo import encode_boards
 import random
 from tqdm import tqdm
 
@@ -50,10 +51,10 @@ class OthelloGames(Dataset):
             else:
                 player, opponent = white, black
 
-            possible_moves = Othello.get_valid_move_list(player, opponent)
+            possible_moves = Othello.advanced_gen_moves(player, opponent)
 
             # If move not valid, pass
-            if moves[move_dex] not in possible_moves:
+            if not possible_moves & Othello.SQUARE_MASKS[moves[move_dex]]:
                 turn_count += 1
 
             # Else, update board states
@@ -68,14 +69,8 @@ class OthelloGames(Dataset):
                 move_dex += 1
                 turn_count += 1
 
-        board = torch.zeros((2,8,8))
-
-        for i in range(8):
-            for j in range(8):
-                if Othello.read_bit(black, i*8+j):
-                    board[0, i, j] = 1
-                elif Othello.read_bit(white, i*8+j):
-                    board[1, i, j] = 1
+        # Layer 0 - Black, Layer 1 - White
+        board = encode_boards([(black, white)])[0]
 
         if move_dex < len(moves):
             next_move_index = moves[move_dex]
@@ -0,0 +1,174 @@
+import Othello as o
+
+"""
+Exact endgame solver. Once few enough squares are empty, negamax alpha-beta search to the end of the game
+is cheaper than random rollouts or a network evaluation, and its result is exact.
+
+Scores are final disc differences (player - opponent) from the view of the side to move, like determine_winner.
+"""
+
+# 4x4 quadrants, used for parity move ordering
+QUADRANTS = (0x000000000F0F0F0F, 0x00000000F0F0F0F0, 0x0F0F0F0F00000000, 0xF0F0F0F000000000)
+
+# Below this many empty squares, move ordering costs more than it saves
+ORDER_MIN_EMPTIES = 6
+
+# Positions with fewer empty squares are not stored in the hash table
+TABLE_MIN_EMPTIES = 5
+
+
+class EndgameSolver:
+
+    def __init__(self, max_empties=8, root_empties=12, table_size=200000):
+        """
+        :param max_empties: Leaves with at most this many empty squares are solved instead of simulated / evaluated
+        :param root_empties: Roots with at most this many empty squares are solved outright, skipping the search
+        :param table_size: Maximum number of hash table entries. The table is cleared when full.
+        """
+        self.max_empties = max_empties
+        self.root_empties = root_empties
+        self.table_size = table_size
+        self.table = {} # (player, opponent) -> (lower bound, upper bound)
+
+        self.nodes = 0 # Searched positions, for measuring
+
+    def can_solve(self, state):
+        return state.empties <= self.max_empties
+
+    def can_solve_root(self, state):
+        return state.empties <= self.root_empties
+
+    def solve(self, player, opponent, alpha=-64, beta=64):
+        """
+        Negamax alpha-beta search to the end of the game.
+        :return: Final disc difference for player with perfect play. Exact if it lies inside (alpha, beta),
+            otherwise a bound on the correct side of the window (fail-soft).
+        """
+        if len(self.table) > self.table_size:
+            self.table.clear()
+
+        return self.search(player, opponent, alpha, beta, False)
+
+    def solve_winner(self, player, opponent):
+        # Null window around 0: only decides win / draw / loss, which is much faster than the exact score.
+        score = self.solve(player, opponent, -1, 1)
+        return (score > 0) - (score < 0) # 1 if player wins, -1 if player loses, 0 if draw
+
+    def best_move(self, player, opponent, exact=False):
+        """
+        Perfect play from the root: a winning move if there is one (exact=False), or the move with the best
+        final disc difference (exact=True, slower). Without a win, exact=False also plays the best disc difference.
+        :return: (move, score). move is -1 if player has to pass. score is win/draw/loss (1, 0, -1) or the disc difference.
+        """
+        if len(self.table) > self.table_size:
+            self.table.clear()
+
+        moves = o.advanced_gen_moves(player, opponent)
+        if moves == 0:
+            score = -self.search(opponent, player, -64, 64, True) if exact else -self.solve_winner(opponent, player)
+            return -1, score
+
+        if exact:
+            return self.search_root(player, opponent, moves, -64, 64)
+
+        best_move, best = self.search_root(player, opponent, moves, -1, 1)
+        if best <= 0:
+            # No winning move. The (-1, 1) window cannot tell a close loss from a heavy one, so the move found is just
+            # the first that failed low: search again with the full window to play the least bad one.
+            best_move, best = self.search_root(player, opponent, moves, -64, 64)
+        return best_move, (best > 0) - (best < 0)
+
+    def search_root(self, player, opponent, moves, alpha, beta):
+        # best_move's search over the legal moves of the root. Returns (move, score) of the best one.
+        empty = ~(player | opponent) & o.FULL
+
+        best_move, best = -1, -65
+        for move in self.order_moves(moves, player, opponent, empty, int.bit_count(empty)):
+            new_player, new_opponent = o.update_board(move, player, opponent)
+            score = -self.search(new_opponent, new_player, -beta, -alpha, False)
+
+            if score > best:
+                best_move, best = move, score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        return best_move, best
+
+    def game_result(self, state):
+        # Same convention as MonteCarlo.random_game: -1 if black won, 1 if white won, 0 if draw
+        result = self.solve_winner(state.player, state.opponent)
+        return -result if state.black_to_play else result
+
+    def search(self, player, opponent, alpha, beta, passed):
+        self.nodes += 1
+
+        moves = o.advanced_gen_moves(player, opponent)
+        if moves == 0:
+            if passed: # Neither player can move -> Game over
+                return int.bit_count(player) - int.bit_count(opponent)
+            return -self.search(opponent, player, -beta, -alpha, True)
+
+        empty = ~(player | opponent) & o.FULL
+        empties = int.bit_count(empty)
+
+        # Hash table cut-off / window narrowing
+        key = None
+        lower, upper = -64, 64
+        if empties >= TABLE_MIN_EMPTIES:
+            key = (player, opponent)
+            entry = self.table.get(key)
+            if entry is not None:
+                lower, upper = entry
+                if lower >= beta: return lower
+                if upper <= alpha: return upper
+                if lower == upper: return lower
+                alpha = max(alpha, lower)
+                beta = min(beta, upper)
+
+        alpha_start = alpha
+        best = -65
+        for move in self.order_moves(moves, player, opponent, empty, empties):
+            new_player, new_opponent = o.update_board(move, player, opponent)
+            score = -self.search(new_opponent, new_player, -beta, -alpha, False)
+
+            if score > best:
+                best = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if key is not None:
+            if best <= alpha_start:
+                self.table[key] = (lower, best) # Fail low -> upper bound
+            elif best >= beta:
+                self.table[key] = (best, upper) # Fail high -> lower bound
+            else:
+                self.table[key] = (best, best)
+
+        return best
+
+    def order_moves(self, moves, player, opponent, empty, empties):
+        """
+        Parity first (moves in quadrants with an odd number of empty squares), then fewest replies for the opponent.
+        Near the very end only parity is used, since computing mobility for every move is not worth it there.
+        """
+        odd = 0
+        for quadrant in QUADRANTS:
+            if int.bit_count(empty & quadrant) & 1:
+                odd |= quadrant
+
+        if empties < ORDER_MIN_EMPTIES:
+            return list(o.iterate_bits(moves & odd)) + list(o.iterate_bits(moves & ~odd))
+
+        keyed = []
+        for move in o.iterate_bits(moves):
+            new_player, new_opponent = o.update_board(move, player, opponent)
+            mobility = int.bit_count(o.advanced_gen_moves(new_opponent, new_player))
+            keyed.append((mobility * 2 + (0 if odd & o.SQUARE_MASKS[move] else 1), move))
+
+        keyed.sort()
+        return [move for _, move in keyed]
+
@@ -0,0 +1,125 @@
+import torch
+from collections import OrderedDict
+import Othello as o
+
+"""
+LRU cache of network outputs for NeuralMonteCarlo, so a position evaluated once (earlier in the same search,
+in the previous move's tree, or in an earlier self-play game) does not cost another forward pass.
+
+Entries are the raw (policy logits, value) for a position. Keys are the zobrist hash of the position with the
+side to move (GameState.key). With symmetric=True, positions are stored in their canonical orientation instead
+(Othello.canonical_position), so all 8 rotations / reflections of a position share one entry: the logits are
+mapped into the canonical frame when stored and back when read. The network only sees the discs of the side to
+move and of the opponent, so symmetric keys ignore the colors too.
+
+The cache remembers which network (and which version of its weights) filled it, and clears itself when asked
+for another one (check_network), so stale outputs are never served after training or loading new weights.
+"""
+
+# SYMMETRY_INDEX[s][move] = index of move in the frame of symmetry s, pass included (see Othello.SYMMETRY_MOVES)
+SYMMETRY_INDEX = [torch.tensor(moves) for moves in o.SYMMETRY_MOVES]
+
+
+def network_version(network):
+    # Changes whenever a weight or BatchNorm statistic of network is modified in place (optimizer steps, load_state_dict)
+    if not isinstance(network, torch.nn.Module):
+        return network.weights_version() # InferenceClient: the weights of its server
+    return id(network), tuple(tensor._version for tensor in network.state_dict(keep_vars=True).values())
+
+
+class EvaluationCache:
+
+    def __init__(self, max_size=100000, symmetric=False):
+        """
+        :param max_size: Maximum number of entries. The least recently used one is dropped when full.
+        :param symmetric: Store positions in canonical symmetry form, so symmetric positions share an entry
+        """
+        self.max_size = max_size
+        self.symmetric = symmetric
+        self.entries = OrderedDict() # key -> (logits, value)
+        self.version = None # network_version of the network the entries came from
+
+        self.hits = 0
+        self.misses = 0
+
+    def check_network(self, network):
+        # Clear the cache if network, or its weights, differ from the ones that filled it. Call before every search.
+        version = network_version(network)
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def key(self, state):
+        """
+        :return: (key, symmetry that maps the position into its stored frame)
+        """
+        if not self.symmetric:
+            return state.key, 0
+
+        player, opponent, symmetry = o.canonical_position(state.player, state.opponent)
+        return (player, opponent), symmetry
+
+    def get(self, state):
+        """
+        :return: (policy logits, value) for state, or None if it is not cached
+        """
+        key, symmetry = self.key(state)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+
+        logits, value = entry
+        if symmetry:
+            logits = logits[SYMMETRY_INDEX[symmetry]] # Canonical frame -> frame of state
+        return logits, value
+
+    def put(self, state, logits, value):
+        key, symmetry = self.key(state)
+        if symmetry:
+            logits = logits[SYMMETRY_INDEX[o.INVERSE_SYMMETRY[symmetry]]] # Frame of state -> canonical frame
+        else:
+            logits = logits.clone() # Don't keep the whole batch alive through a view
+
+        self.entries[key] = (logits, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+if __name__ == '__main__':
+    import time
+    from NeuralMonteCarlo import NeuralMonteCarlo
+    from AlphaZeroNetwork import AlphaZeroNet
+    from Endgame import EndgameSolver
+    from GameState import GameState
+
+    network = AlphaZeroNet().eval()
+
+    # The same few moves searched twice: the second search gets most of its positions from the cache
+    for symmetric in (False, True):
+        cache = EvaluationCache(symmetric=symmetric)
+        for search in range(2):
+            state = GameState()
+            start = time.perf_counter()
+            for _ in range(4):
+                mcts = NeuralMonteCarlo(network, state, solver=EndgameSolver(0, 0), cache=cache, batch_size=8)
+                mcts.run_iterations(200)
+                state = state.play(mcts.get_move_to_play())
+            print(f'symmetric={symmetric}, search {search + 1}: {time.perf_counter() - start:.2f}s, '
+                  f'{len(cache)} entries, hit rate {cache.hit_rate():.0%}')
@@ -80,42 +80,26 @@ class Display:
         circle_spacing = self.bar_spacing / 2
         circle_radius = self.bar_spacing / 2 - 5
 
-        for i in range(pow(self.GRID_COUNT, 2)):
-            x: int = self.LABEL_OFFSET
-            y: int = self.LABEL_OFFSET
-            if Othello.read_bit(white, i):
-                x += (i % self.GRID_COUNT) * self.bar_spacing + (i % self.GRID_COUNT + 1) * self.BAR_WIDTH + circle_spacing
-                y += (i // self.GRID_COUNT) * self.bar_spacing + (i // self.GRID_COUNT + 1) * self.BAR_WIDTH + circle_spacing
+        # Only visit the squares that actually hold something
+        for board, color in ((white, "white"), (black, "black"), (poss_moves, "green")):
+            for i in Othello.iterate_bits(board):
+                row, col = Othello.SQUARE_COORDS[i]
+                x = self.LABEL_OFFSET + col * self.bar_spacing + (col + 1) * self.BAR_WIDTH + circle_spacing
+                y = self.LABEL_OFFSET + row * self.bar_spacing + (row + 1) * self.BAR_WIDTH + circle_spacing
                 center = Point(x, y)
                 piece = Circle(center, circle_radius)
-                piece.setFill(color="white")
-                self.player_pieces.append(piece)
-                piece.draw(self.win)
-
-            elif Othello.read_bit(black, i):
-                x += (i % self.GRID_COUNT) * self.bar_spacing + (i % self.GRID_COUNT + 1) * self.BAR_WIDTH + circle_spacing
-                y += (i // self.GRID_COUNT) * self.bar_spacing + (i // self.GRID_COUNT + 1) * self.BAR_WIDTH + circle_spacing
-                center = Point(x, y)
-                piece = Circle(center, circle_radius)
-                piece.setFill(color="black")
-                self.player_pieces.append(piece)
-                piece.draw(self.win)
-
-            elif Othello.read_bit(poss_moves, i):
-                x += (i % self.GRID_COUNT) * self.bar_spacing + (i % self.GRID_COUNT + 1) * self.BAR_WIDTH + circle_spacing
-                y += (i // self.GRID_COUNT) * self.bar_spacing + (i // self.GRID_COUNT + 1) * self.BAR_WIDTH + circle_spacing
-                center = Point(x, y)
-                piece = Circle(center, circle_radius)
-                piece.setFill(color="green")
+                piece.setFill(color=color)
                 self.player_pieces.append(piece)
                 piece.draw(self.win)
 
     def is_valid(self, valid_moves, chosen_spot):
-        for v in valid_moves:
-            if v == chosen_spot:
-                return True
+        """
+        valid_moves = Bitboard of the legal moves.
+        """
+        if not 0 <= chosen_spot < pow(self.GRID_COUNT, 2):
+            return False
 
-        return False
+        return valid_moves & Othello.SQUARE_MASKS[int(chosen_spot)] != 0
 
     def ask_user_input(self, valid_moves) -> int:
         print("Click a valid spot")
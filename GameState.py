@@ -0,0 +1,97 @@
+import Othello as o
+
+START_WHITE = 34628173824
+START_BLACK = 68853694464
+
+
+class GameState:
+    """
+    One Othello position: both bitboards and the number of turns played so far (passes included), whose parity
+    decides the side to move. Treat it as immutable: play() returns a new state. The legal moves and the zobrist
+    hash are computed on first use and cached, so passing a state around never recomputes them.
+    """
+    __slots__ = ('white', 'black', 'turn_count', 'black_to_play', '_moves', '_key')
+
+    def __init__(self, white=START_WHITE, black=START_BLACK, turn_count=0, key=None):
+        self.white = white
+        self.black = black
+        self.turn_count = turn_count
+        self.black_to_play = turn_count % 2 == 0
+
+        self._moves = None
+        self._key = key
+
+    @property
+    def player(self):
+        # Board of the side to move
+        return self.black if self.black_to_play else self.white
+
+    @property
+    def opponent(self):
+        return self.white if self.black_to_play else self.black
+
+    @property
+    def moves(self):
+        # Bitboard of the legal moves for the side to move
+        if self._moves is None:
+            self._moves = o.advanced_gen_moves(self.player, self.opponent)
+        return self._moves
+
+    @property
+    def key(self):
+        # Othello.zobrist_hash, side to move included
+        if self._key is None:
+            self._key = o.zobrist_hash(self.white, self.black, self.black_to_play)
+        return self._key
+
+    @property
+    def empties(self):
+        return 64 - int.bit_count(self.white | self.black)
+
+    def must_pass(self):
+        return self.moves == 0
+
+    def is_terminal(self):
+        # Neither side can move
+        return self.moves == 0 and o.advanced_gen_moves(self.opponent, self.player) == 0
+
+    def winner(self):
+        # 1 if white wins, -1 if black wins, 0 for a draw (see Othello.determine_winner)
+        return o.determine_winner(self.white, self.black)
+
+    def play(self, move):
+        """
+        :param move: Square index, or -1 to pass (boards unchanged, other side to move)
+        :return: The GameState after the move. The hash is updated incrementally if it was already known.
+        """
+        if move == -1:
+            key = self._key ^ o.ZOBRIST_SIDE if self._key is not None else None
+            return GameState(self.white, self.black, self.turn_count + 1, key)
+
+        player, opponent = self.player, self.opponent
+        flips = o.flip_mask(move, player, opponent)
+        player, opponent = player | flips | o.SQUARE_MASKS[move], opponent & ~flips
+
+        key = o.update_hash(self._key, move, flips, self.black_to_play) if self._key is not None else None
+
+        if self.black_to_play:
+            return GameState(opponent, player, self.turn_count + 1, key)
+        return GameState(player, opponent, self.turn_count + 1, key)
+
+    def children(self):
+        # (move, GameState) for every legal move, or the pass if there are none
+        if self.moves == 0:
+            yield -1, self.play(-1)
+        else:
+            for move in o.iterate_bits(self.moves):
+                yield move, self.play(move)
+
+    def __eq__(self, other):
+        return isinstance(other, GameState) and self.white == other.white and self.black == other.black \
+            and self.black_to_play == other.black_to_play
+
+    def __hash__(self):
+        return self.key
+
+    def __repr__(self):
+        return f'GameState(white={self.white}, black={self.black}, turn_count={self.turn_count})'
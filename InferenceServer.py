@@ -0,0 +1,295 @@
+import os
+import copy
+import time
+import queue
+import threading
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from AlphaZeroNetwork import AlphaZeroNet
+
+"""
+Local inference service: one process holds the network, any number of search processes (self-play workers, arena
+matches) send it their positions over a localhost socket instead of keeping a copy each.
+
+The server gathers the requests of all its clients into dynamic batches: a batch is run as soon as it holds
+max_batch positions, or max_latency milliseconds after its first request came in, whichever is first. New weights
+can be loaded while it runs (InferenceClient.load_weights), between two batches, e.g. after every training epoch.
+A request that fails (bad weights, bad input) gets the error back instead of its result, and the server keeps running.
+
+Connections are authenticated with a key shared by the server and its clients. Messages are pickled, so anyone who
+has the key can run code in the server: start_server makes a random one for every server.
+
+InferenceClient is called like the network itself (positions in, (policy logits, value) out), so it can be given to
+NeuralMonteCarlo, the self-play functions or Play in place of an AlphaZeroNet. EvaluationCache asks it for the
+version of the server's weights, so cached outputs are dropped after a swap.
+"""
+
+DEFAULT_ADDRESS = ('localhost', 6010)
+
+
+def server_error(error):
+    # What a client gets back for a request that failed, raised again on its side (InferenceClient.request)
+    return RuntimeError(f'Inference server: {type(error).__name__}: {error}')
+
+
+class InferenceServer:
+
+    def __init__(self, network, authkey, address=DEFAULT_ADDRESS, max_batch=256, max_latency=2):
+        """
+        :param network: AlphaZeroNet to serve, put in eval mode
+        :param authkey: Key the clients have to connect with (bytes), see start_server
+        :param max_batch: Most positions run in one forward pass
+        :param max_latency: Milliseconds a request may wait for others to join its batch
+        """
+        self.network = network.eval()
+        self.address = address
+        self.authkey = authkey
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+
+        self.version = 0 # Incremented by every weight swap
+        self.requests = queue.Queue() # (connection, message), filled by one reader thread per client
+        self.running = False
+
+        self.batches = 0
+        self.positions = 0
+
+    def serve(self):
+        # Answer requests until a client sends 'shutdown'
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    connection, message = self.requests.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                try:
+                    if message[0] == 'evaluate':
+                        self.run_batch(connection, message[1])
+                    else:
+                        self.control(connection, message)
+                except Exception as error:
+                    self.send(connection, server_error(error))
+        finally:
+            listener.close()
+
+    def accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError):
+                continue # Client without the key, or gone during the handshake
+            except OSError:
+                return # Listener closed
+            threading.Thread(target=self.read, args=(connection,), daemon=True).start()
+
+    def read(self, connection):
+        # Pass every message of one client on to the batching loop, until it disconnects
+        try:
+            while True:
+                self.requests.put((connection, connection.recv()))
+        except (EOFError, OSError):
+            connection.close()
+
+    def run_batch(self, connection, positions):
+        """
+        Gather requests behind the one just received until the batch is full or its deadline has passed,
+        evaluate them in one forward pass and send every client its part of the result.
+        Other messages that come in meanwhile are handled after the batch.
+        """
+        batch = [(connection, positions)]
+        size = len(positions)
+        deadline = time.perf_counter() + self.max_latency / 1000
+        deferred = []
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                connection, message = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if message[0] == 'evaluate':
+                batch.append((connection, message[1]))
+                size += len(message[1])
+            else:
+                deferred.append((connection, message))
+
+        try:
+            p, v = self.forward(np.concatenate([positions for _, positions in batch]))
+        except Exception:
+            # Some request is malformed: run them one at a time, so only the bad ones get the error
+            for connection, positions in batch:
+                try:
+                    self.send(connection, self.forward(positions))
+                except Exception as error:
+                    self.send(connection, server_error(error))
+        else:
+            start = 0
+            for connection, positions in batch:
+                end = start + len(positions)
+                self.send(connection, (p[start:end], v[start:end]))
+                start = end
+
+        self.batches += 1
+        self.positions += size
+
+        for connection, message in deferred:
+            try:
+                self.control(connection, message)
+            except Exception as error:
+                self.send(connection, server_error(error))
+
+    def forward(self, positions):
+        with torch.no_grad():
+            p, v = self.network(torch.from_numpy(positions))
+        return p.numpy(), v.numpy()
+
+    def control(self, connection, message):
+        match message[0]:
+            case 'version':
+                self.send(connection, self.version)
+            case 'load':
+                # Loaded into a copy, so weights that do not fit leave the served network untouched
+                network = copy.deepcopy(self.network)
+                network.load_state_dict(message[1])
+                self.network = network.eval()
+                self.version += 1
+                self.send(connection, self.version)
+            case 'stats':
+                self.send(connection, {'version': self.version, 'batches': self.batches, 'positions': self.positions,
+                                       'mean_batch': self.positions / self.batches if self.batches else 0})
+            case 'shutdown':
+                self.running = False
+                self.send(connection, None)
+            case _:
+                self.send(connection, ValueError(f'Unknown request {message[0]!r}'))
+
+    @staticmethod
+    def send(connection, reply):
+        try:
+            connection.send(reply)
+        except OSError:
+            pass # Client gone, its reader thread cleans up
+
+
+def run_server(checkpoint, authkey, address=DEFAULT_ADDRESS, max_batch=256, max_latency=2):
+    # Entry point of the server process: load the checkpoint (random weights if None) and serve
+    network = AlphaZeroNet()
+    if checkpoint is not None:
+        network.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    InferenceServer(network, authkey, address, max_batch, max_latency).serve()
+
+def start_server(checkpoint=None, address=DEFAULT_ADDRESS, max_batch=256, max_latency=2):
+    """
+    Run an inference server in a new process, with a random key only its clients know.
+    :return: (the process, an InferenceClient connected to it once it is up). Pass the client (or its authkey)
+        to the processes that should use the server.
+    """
+    authkey = os.urandom(32)
+    process = mp.Process(target=run_server, args=(checkpoint, authkey, address, max_batch, max_latency), daemon=True)
+    process.start()
+    return process, InferenceClient(authkey, address)
+
+
+class InferenceClient:
+    # Stands in for the network in a search, sending its positions to an InferenceServer
+
+    def __init__(self, authkey, address=DEFAULT_ADDRESS, connect_timeout=30):
+        """
+        :param authkey: Key of the server (see start_server)
+        :param connect_timeout: Seconds to keep retrying the first connection, while the server starts up
+        """
+        self.address = address
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self.connection = None
+        self.pid = None # Process that opened the connection. A forked or unpickled copy opens its own.
+
+    def connect(self):
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+
+        deadline = time.perf_counter() + self.connect_timeout
+        while True:
+            try:
+                self.connection = Client(self.address, authkey=self.authkey)
+                break
+            except ConnectionRefusedError:
+                if time.perf_counter() > deadline:
+                    raise
+                time.sleep(0.05)
+        self.pid = os.getpid()
+        return self.connection
+
+    def request(self, *message):
+        connection = self.connect()
+        connection.send(message)
+        reply = connection.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def __call__(self, x):
+        # Same interface as AlphaZeroNet.forward: N x 3 x 8 x 8 positions -> (N x 65 policy logits, N values)
+        p, v = self.request('evaluate', x.numpy())
+        return torch.from_numpy(p), torch.from_numpy(v)
+
+    def eval(self):
+        # The server's network is always in eval mode
+        return self
+
+    def weights_version(self):
+        # Identifies the weights the server answers with (see EvaluationCache.network_version)
+        return self.address, self.request('version')
+
+    def load_weights(self, weights):
+        """
+        Swap the server's weights, between two batches.
+        :param weights: state_dict, or path of a checkpoint saved with torch.save
+        :return: New version number of the weights
+        """
+        if isinstance(weights, str):
+            weights = torch.load(weights, map_location='cpu')
+        return self.request('load', {name: tensor.cpu() for name, tensor in weights.items()})
+
+    def stats(self):
+        # Batches and positions run by the server so far
+        return self.request('stats')
+
+    def shutdown(self):
+        self.request('shutdown')
+        self.close()
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+
+    def __getstate__(self):
+        # Sent to another process: only the address, it connects on its own
+        return {'address': self.address, 'authkey': self.authkey, 'connect_timeout': self.connect_timeout,
+                'connection': None, 'pid': None}
+
+
+if __name__ == '__main__':
+    import TrainingDataGeneration as tdg
+
+    # Two self-play worker processes sharing one server instead of holding a network each
+    server, client = start_server('Models/zero.pt')
+    start = time.perf_counter()
+    data = tdg.pool_self_play(client, 4, 2, mcts_its_per_turn=50, parallel_games=2)
+    print(f'{len(data)} positions in {time.perf_counter() - start:.1f}s, server: {client.stats()}')
+
+    # Hot swap, e.g. after a training epoch
+    print('Weights version', client.load_weights('Models/zero.pt'))
+    client.shutdown()
+    server.join()
@@ -1,44 +1,66 @@
+import os
+import queue
 import random
+import math
+import time
+import multiprocessing
 import Othello as o
+import numpy as np
 import Board as b
+import BatchOthello as bo
+import TreeMemory as tm
+import Telemetry as tl
+from ArrayTree import ArrayTree, ArrayNode, UNPROVEN
+from GameState import GameState
+from Endgame import EndgameSolver
+from TimeControl import SearchBudget, DECIDED_CHECK_EVERY
 from tqdm import tqdm
 
 def display_node(node, indent = 0):
     display_indent = ('|    ' * indent) if indent > 0 else ''
 
     print(display_indent, end='')
-    if node.to_play: print("Black's Turn")
+    if node.state.black_to_play: print("Black's Turn")
     else: print("White's Turn")
 
     print(f'{display_indent}| visits: {node.visits}')
     print(f'{display_indent}| score: {node.score}')
-    print(f'{display_indent}| Available Moves: {node.available_moves}')
+    if node.proven is not None:
+        print(f'{display_indent}| Proven: {("Loss", "Draw", "Win")[node.proven + 1]}')
+    print(f'{display_indent}| Available Moves: {[m if m != 64 else -1 for m in o.iterate_bits(node.available_moves)]}')
     print(f'{display_indent}| Explored Moves: {[child.move for child in node.children]}')
     if node.parent is not None:
         print(f'{display_indent}| UCT: {node.compute_UCT(2)}')
         print(f'{display_indent}| Move: {node.move}')
-    print(f'{display_indent}| black: {int.bit_count(node.black)} Tiles')
-    print(f'{display_indent}| white: {int.bit_count(node.white)} Tiles')
+    print(f'{display_indent}| black: {int.bit_count(node.state.black)} Tiles')
+    print(f'{display_indent}| white: {int.bit_count(node.state.white)} Tiles')
     print(f'{display_indent}|')
 
-def create_root():
-    root = b.Node()
+def create_root(table = None, array_tree = False, state = None):
+    # array_tree: Use the ArrayTree store instead of Board.Node objects (the table is not used then)
+    # state: GameState of the root, the start position if None
+    if array_tree:
+        return ArrayNode(ArrayTree(state))
+
+    root = b.Node(state=state, table=table)
     root.visits = 1
     return root
 
-def random_game(white = 34628173824, black = 68853694464, turn_count = 0):
-    # Determining who black and white is and assigning to current player/opponent
-    if turn_count % 2 == 0: player, opponent = black, white
-    else: player, opponent = white, black
+def random_game(state = None):
+    if state is None: state = GameState()
+
+    # Current player/opponent boards. The loop below stays on plain ints for speed.
+    player, opponent = state.player, state.opponent
+    turn_count = state.turn_count
 
     last_turn_pass = False
     while True:
-        # Get all current valid moves
-        valid_moves = o.get_valid_move_list(player, opponent)
+        # Get all current valid moves as a bitboard
+        valid_moves = o.advanced_gen_moves(player, opponent)
 
-        # If the length is 0, then pass value is given (-1)
-        if len(valid_moves) == 0: chosen_move = -1
-        else: chosen_move = random.choice(valid_moves)
+        # If there are none, then pass value is given (-1)
+        if valid_moves == 0: chosen_move = -1
+        else: chosen_move = o.random_bit(valid_moves)
 
         if chosen_move == -1:
             if last_turn_pass:
@@ -59,39 +81,83 @@ def random_game(white = 34628173824, black = 68853694464, turn_count = 0):
         player, opponent = opponent, player
         turn_count += 1
 
-# Node __init__(self, parent=None, white=34628173824, black=68853694464, turn_count=0)
+def random_games(state = None, playouts = 1):
+    # Average result of `playouts` random games from the same position, played in lockstep (see BatchOthello)
+    if state is None: state = GameState()
+    return float(bo.random_games(state.white, state.black, state.turn_count, playouts).mean())
+
+# Node __init__(self, parent=None, state=None, move=-1, table=None)
 class MonteCarlo:
-    def __init__(self, root):
+    def __init__(self, root, playouts = 1, solver = None, max_nodes = None):
         self.root = root
+        self.playouts = playouts # Random games per simulated leaf. Above 1, they are played as one batch.
+        self.solver = solver # EndgameSolver: leaves it can solve get the exact result instead of a rollout
+
+        # Node budget: past it, the tree is pruned back (see TreeMemory.prune). None for no limit.
+        self.max_nodes = max_nodes
+        self.nodes = tm.count_nodes(root) if max_nodes is not None else 0
 
 
     def selection(self, node, C):
         while node.is_explored():
-            utc = [(child, child.compute_UCT(C)) for child in node.children]
-            max_utc = max([child[1] for child in utc])
-            selected_node = random.choice([child for child in utc if child[1] == max_utc])[0]
-            node = selected_node
+            node = node.select_child(C)
         return node
 
 
     def expansion(self, parent):
         child = parent.make_child()
+        self.nodes += 1
         return child
 
 
     def simulation(self, node):
-        score = random_game(node.white, node.black, node.turn_count)
+        if node.proven is not None:
+            return node.result()
+
+        if node.visits > 0:
+            # Transposition: this position was already simulated through another path. Reuse its mean result.
+            # Scores are stored from the view of the player who moved into the node, so convert back to white's view
+            mean = node.score / node.visits
+            return mean if node.state.black_to_play else -mean
+
+        if self.solver is not None and self.solver.can_solve(node.state):
+            result = self.solver.game_result(node.state)
+            node.prove(result) # Exact, so the node never has to be searched again
+            return result
+
+        if self.playouts == 1:
+            score = random_game(node.state)
+        else:
+            score = random_games(node.state, self.playouts)
         return score
 
 
     def backpropagation(self, node, score):
+        if node.proven is not None:
+            self.propagate_proven(node)
+
         # While not the root of the tree
         while node.parent is not None:
-            if node.to_play:
-                node.score += score
+            if node.state.black_to_play:
+                node.add_result(score)
             else:
-                node.score += -score
-            node.visits += 1
+                node.add_result(-score)
+            node = node.parent
+
+
+    def over_budget(self):
+        return self.max_nodes is not None and self.nodes > self.max_nodes
+
+
+    def enforce_budget(self):
+        # Prune once the tree is over its node budget. Only between iterations, with no leaf waiting for a result.
+        if self.over_budget():
+            self.root, self.nodes = tm.prune(self.root, self.max_nodes)
+
+
+    def propagate_proven(self, node):
+        # Carry a new proof up the tree for as long as it decides the parent, up to the root of the search
+        while node is not self.root and node.parent.proven is None and node.parent.update_proven(node):
             node = node.parent
 
 
@@ -101,49 +167,480 @@ class MonteCarlo:
         for child in node.children:
             self.display(child, indent + 1)
 
-def monte_carlo_tree_search(root = None, iterations = 100, C = 2):
+class ArrayMonteCarlo:
+    """
+    MonteCarlo on an ArrayTree: the same four steps, on node indices instead of Board.Node objects.
+    UCT over the children of a node is one vectorized expression, since they sit next to each other in the arrays.
+    Nodes do not share statistics across transpositions. Proven results work like MonteCarlo (see ArrayTree.update_proven).
+    """
+    def __init__(self, tree, playouts = 1, solver = None, max_nodes = None):
+        self.tree = tree
+        self.playouts = playouts
+        self.solver = solver
+
+        self.max_nodes = max_nodes
+        self.nodes = tree.node_count() if max_nodes is not None else 0
+
+
+    def selection(self, C):
+        # Returns the path from the root (index 0) to the selected node.
+        # Ties go to the first child in the block, which is random since blocks are shuffled when allocated.
+        tree = self.tree
+        first_child, child_count, expanded = tree.first_child, tree.child_count, tree.expanded
+        visits, score, proven, proven_children = tree.visits, tree.score, tree.proven, tree.proven_children
+
+        node = 0
+        path = [node]
+        while True:
+            start = int(first_child[node])
+            if start == -1 or expanded[node] != child_count[node]:
+                return path
+
+            end = start + int(child_count[node])
+            child_visits = visits[start:end]
+            utc = score[start:end] / child_visits + C * np.sqrt(math.log(visits[node]) / child_visits)
+            if proven_children[node]:
+                utc[proven[start:end] != UNPROVEN] = -np.inf
+
+            node = start + int(utc.argmax())
+            path.append(node)
+
+
+    def expansion(self, parent):
+        self.nodes += 1
+        return self.tree.expand(parent)
+
+
+    def over_budget(self):
+        return self.max_nodes is not None and self.nodes > self.max_nodes
+
+
+    def enforce_budget(self):
+        # MonteCarlo.enforce_budget. Pruning copies the tree, so the root is always index 0 of self.tree.
+        if self.over_budget():
+            root, self.nodes = tm.prune(ArrayNode(self.tree), self.max_nodes)
+            self.tree = root.tree
+
+
+    def simulation(self, node):
+        if self.tree.proven[node] != UNPROVEN:
+            return self.tree.result(node)
+
+        state = self.tree.state(node)
+        if self.solver is not None and self.solver.can_solve(state):
+            result = self.solver.game_result(state)
+            self.tree.prove(node, result)
+            return result
+
+        if self.playouts == 1:
+            return random_game(state)
+        return random_games(state, self.playouts)
+
+
+    def backpropagation(self, path, score):
+        # A proven leaf first proves as many of its ancestors as it decides
+        k = len(path) - 1
+        while k > 0 and self.tree.proven[path[k]] != UNPROVEN and self.tree.update_proven(path[k - 1], path[k]):
+            k -= 1
+
+        # Every node on the path except the root, scored from the view of the player who moved into it
+        visits, scores, turn_count = self.tree.visits, self.tree.score, self.tree.turn_count
+        for node in path[1:]:
+            scores[node] += score if turn_count[node] % 2 == 0 else -score
+            visits[node] += 1
+
+def root_visit_counts(root):
+    # Visits of every root move, 0 for the moves without a child yet (see SearchBudget.decided)
+    return [child.visits for child in root.children] + [0] * int.bit_count(root.available_moves)
+
+def solve_root(root, solver):
+    move, _ = solver.best_move(root.state.player, root.state.opponent)
+
+    # Same return as compute_best_score: the child for the move, and the move
+    for child in root.children:
+        if child.move == move:
+            return child, move
+    return root.make_child(move), move
+
+def monte_carlo_tree_search(root = None, iterations = 100, C = 2, playouts = 1, table = None, solver = None,
+                            array_tree = False, workers = 1, parallel = 'root', pool = None, progress = True,
+                            time_limit = None, stop = None, early_stop = None, max_nodes = None, telemetry = None):
+    # table: Optional TranspositionTable, only used when a new root is created. Existing roots keep theirs.
+    # solver: EndgameSolver for the last empty squares. Keep one per game so its hash table carries over between moves.
+    #   None creates a default one, EndgameSolver(0, 0) turns solving off.
+    # array_tree: Search on an ArrayTree (see ArrayTree.py) when a new root is created. ArrayNode roots always do.
+    # workers: Processes to search with
+    # parallel: 'root' for independent searches merged at the root when workers > 1 (root_parallel_search),
+    #   'leaf' for one shared tree whose rollouts run in the workers (LeafParallelMonteCarlo, Board.Node trees only)
+    # pool: multiprocessing Pool for the workers, a temporary one is created if None
+    # progress: Show the tqdm progress bar
+    # time_limit: Milliseconds to search for. iterations can then be None to search until the deadline.
+    # stop: threading.Event that ends the search when set. Not seen by root-parallel workers.
+    # early_stop: End as soon as the most visited root move can no longer be overtaken (see SearchBudget.decided).
+    #   None turns it on only for a time_limit or stop search, so a fixed iteration count is always run in full.
+    # max_nodes: Node budget for the tree. Past it, the subtrees of the least visited nodes are pruned (TreeMemory.prune).
+    #   Root-parallel workers get the same budget each.
+    # telemetry: Telemetry object to record the search in (see Telemetry.py), None to record nothing.
+    #   The parallel searches only record their totals and the tree, their phases overlap across processes.
+    # The search always runs at least one iteration, and returns the best move found so far.
+    budget = SearchBudget(iterations, time_limit, stop) # Raises if no limit is given
+    if early_stop is None:
+        early_stop = budget.timed()
+
+    if solver is None:
+        solver = EndgameSolver()
+
     if root is None:
-        tree = MonteCarlo(create_root())
-    else:
-        if root.visits < 1: root.visits = 1
-        tree = MonteCarlo(root)
+        root = create_root(table, array_tree)
+    elif root.visits < 1:
+        root.visits = 1
+
+    # Already solved by an earlier search (reused root)
+    if root.proven is not None and root.children:
+        return root.compute_best_score()
+
+    # Few enough empty squares -> play perfectly instead of searching
+    if solver.can_solve_root(root.state):
+        return solve_root(root, solver)
+
+    if telemetry is not None:
+        telemetry.begin()
+
+    if parallel == 'leaf' or workers > 1:
+        if parallel == 'leaf':
+            node, move = leaf_parallel_search(root, budget, C, playouts, solver, workers, pool, progress, early_stop,
+                                              max_nodes=max_nodes)
+        else:
+            node, move = root_parallel_search(root.state, iterations, C, playouts, solver, isinstance(root, ArrayNode),
+                                              workers, pool, time_limit, early_stop, max_nodes)
+        if telemetry is not None:
+            # node.parent is the searched root, or the merged root of the root-parallel searches
+            telemetry.end(node.parent, budget.done if parallel == 'leaf' else node.parent.visits)
+        return node, move
+
+    if isinstance(root, ArrayNode):
+        return array_tree_search(root, budget, C, playouts, solver, progress, early_stop, max_nodes, telemetry)
+
+    tree = MonteCarlo(root, playouts, solver, max_nodes)
+
+    progress_bar = tqdm(total=iterations, disable=not progress)
+    while budget.done == 0 or not budget.exhausted():
+        if telemetry is not None:
+            telemetry.start()
 
-    progress_bar = tqdm(range(iterations))
-    for iteration in progress_bar:
         #Returns Child that has available moves using UCT
         node = tree.selection(tree.root, C)
+        if telemetry is not None:
+            telemetry.lap('selection')
 
         # Creates and returns Child node of Root
         child = tree.expansion(node)
+        if telemetry is not None:
+            telemetry.lap('expansion')
 
         #
         score = tree.simulation(child)
+        if telemetry is not None:
+            telemetry.lap('simulation')
+
         tree.backpropagation(child, score)
+        if telemetry is not None:
+            telemetry.lap('backpropagation')
+            telemetry.leaf(tl.node_depth(child, tree.root), int.bit_count(node.state.moves) or 1)
+
+        tree.enforce_budget()
 
-        if (iteration + 1) % 100 == 0:
+        budget.tick()
+        progress_bar.update()
+        if budget.done % 100 == 0:
             best_move = tree.root.compute_best_score()[1]
-            move = f'{chr(best_move % 8 + 65)}{best_move // 8 + 1}' if best_move != -1 else 'pass'
-            progress_bar.set_postfix({'Top Move': {move}})
+            progress_bar.set_postfix({'Top Move': {o.move_name(best_move)}})
+
+        if tree.root.proven is not None:
+            break # Solved: the best move is known exactly
+        if early_stop and budget.done % DECIDED_CHECK_EVERY == 0 and budget.decided(root_visit_counts(tree.root)):
+            break
+    progress_bar.close()
+
+    if telemetry is not None:
+        telemetry.end(tree.root)
 
     #DEBUG BELOW: Display entire Tree
     # tree.display(tree.root)
     return tree.root.compute_best_score()
 
+def array_tree_search(root, budget, C, playouts, solver, progress = True, early_stop = None, max_nodes = None,
+                      telemetry = None):
+    # monte_carlo_tree_search on an ArrayTree. A root deeper in the tree (reused from the last move) is first
+    # copied out into a compact tree of its own, which drops the rest of the old tree.
+    if early_stop is None:
+        early_stop = budget.timed()
+    if root.index != 0:
+        root = ArrayNode(root.tree.subtree(root.index))
+    tree = ArrayMonteCarlo(root.tree, playouts, solver, max_nodes)
+
+    progress_bar = tqdm(total=budget.iterations, disable=not progress)
+    while budget.done == 0 or not budget.exhausted():
+        if telemetry is not None:
+            telemetry.start()
+
+        path = tree.selection(C)
+        if telemetry is not None:
+            telemetry.lap('selection')
+
+        child = tree.expansion(path[-1])
+        path.append(child)
+        if telemetry is not None:
+            telemetry.lap('expansion')
+
+        score = tree.simulation(child)
+        if telemetry is not None:
+            telemetry.lap('simulation')
+
+        tree.backpropagation(path, score)
+        if telemetry is not None:
+            telemetry.lap('backpropagation')
+            telemetry.leaf(len(path) - 1, int(tree.tree.child_count[path[-2]]))
+
+        if tree.over_budget():
+            tree.enforce_budget()
+            root = ArrayNode(tree.tree)
+
+        budget.tick()
+        progress_bar.update()
+        if budget.done % 100 == 0:
+            best_move = root.compute_best_score()[1]
+            progress_bar.set_postfix({'Top Move': {o.move_name(best_move)}})
+
+        if root.proven is not None:
+            break
+        if early_stop and budget.done % DECIDED_CHECK_EVERY == 0 and budget.decided(root_visit_counts(root)):
+            break
+    progress_bar.close()
+
+    if telemetry is not None:
+        telemetry.end(root)
+
+    return root.compute_best_score()
+
+def root_parallel_worker(job):
+    # One search of root_parallel_search, run in a worker process. Returns (move, visits, score, proven) of every root child.
+    state, iterations, C, playouts, max_empties, root_empties, array_tree, seed, time_limit, early_stop, max_nodes = job
+    random.seed(seed)
+    bo.RNG = np.random.default_rng(seed)
+
+    root = create_root(None, array_tree, state)
+    monte_carlo_tree_search(root, iterations, C, playouts, None, EndgameSolver(max_empties, root_empties),
+                            progress=False, time_limit=time_limit, early_stop=early_stop, max_nodes=max_nodes)
+    return [(child.move, child.visits, child.score, child.proven) for child in root.children]
+
+def root_parallel_search(state, iterations, C, playouts, solver, array_tree, workers, pool = None, time_limit = None,
+                         early_stop = None, max_nodes = None):
+    '''
+    Root parallelization: `workers` independent searches from the same position, each with `iterations`
+    iterations and its own random seed, in separate processes. The visits and scores of every root move
+    are summed over the searches, and the move is picked from the sums like compute_best_score.
+    :param pool: multiprocessing Pool to run on. A temporary one is created if None.
+    :param time_limit: Milliseconds for every worker's search, counted from when the worker starts
+    :param early_stop: Let every worker stop once its own most visited move is decided. None: only with a time_limit.
+    :param max_nodes: Node budget of every worker's tree
+    :return: (child, move) like monte_carlo_tree_search. child belongs to a new merged root holding the summed
+        statistics of the root moves. The deeper parts of the worker trees are not kept.
+    '''
+    if early_stop is None:
+        early_stop = time_limit is not None
+    seed = random.getrandbits(32)
+    jobs = [(state, iterations, C, playouts, solver.max_empties, solver.root_empties, array_tree, seed + k, time_limit,
+             early_stop, max_nodes) for k in range(workers)]
+
+    if pool is None:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(root_parallel_worker, jobs)
+    else:
+        results = pool.map(root_parallel_worker, jobs)
+
+    merged = {} # move -> [visits, score, proven]. A result proven by any worker holds for all of them.
+    for result in results:
+        for move, visits, score, proven in result:
+            stats = merged.setdefault(move, [0, 0, None])
+            stats[0] += visits
+            stats[1] += score
+            if proven is not None:
+                stats[2] = proven
+
+    root = create_root(None, array_tree, state)
+    for move, (visits, score, proven) in merged.items():
+        child = root.make_child(move)
+        child.add_result(score, visits)
+        if proven is not None and child.proven is None:
+            child.proven = proven
+            root.update_proven(child)
+    root.visits = max(1, sum(visits for visits, _, _ in merged.values()))
+
+    return root.compute_best_score()
+
+
+_seeded_pid = None
+
+def rollout_worker(job):
+    # One leaf simulation of LeafParallelMonteCarlo, run in a worker process.
+    # Forked workers start with copies of the parent's random state, so each process reseeds on its first job.
+    global _seeded_pid
+    if _seeded_pid != os.getpid():
+        random.seed()
+        bo.RNG = np.random.default_rng()
+        _seeded_pid = os.getpid()
+
+    state, playouts = job
+    if playouts == 1:
+        return random_game(state)
+    return random_games(state, playouts)
+
+class LeafParallelMonteCarlo(MonteCarlo):
+    '''
+    MonteCarlo on one shared tree, with the rollouts of several leaves running at once in a process pool.
+    The coordinator keeps up to `in_flight` leaves out. Every leaf sent out puts a virtual loss on its path
+    (`virtual_loss` extra visits that all count as losses), so the next selections spread over other branches
+    instead of all walking down to the same leaf. The virtual loss is taken back when the result arrives and
+    goes through backpropagation like a serial result.
+    The virtual loss only goes into the parents' per-child lists and the nodes' virtual_visits, never into the
+    stats Entry: transpositions share it, and would take the virtual loss for a real result.
+    '''
+    def __init__(self, root, pool, playouts = 1, solver = None, in_flight = 2, virtual_loss = 1, max_nodes = None):
+        super().__init__(root, playouts, solver, max_nodes)
+        self.pool = pool
+        self.in_flight = in_flight
+        self.virtual_loss = virtual_loss
+        self.in_flight_stats = {} # id of the Entry of every position with a rollout in flight -> rollouts
+
+
+    def add_virtual_loss(self, node, amount):
+        # Negative amounts remove it again. Scores are from the view of the player who moved into the node.
+        key = id(node.stats)
+        self.in_flight_stats[key] = self.in_flight_stats.get(key, 0) + (1 if amount > 0 else -1)
+        if self.in_flight_stats[key] == 0:
+            del self.in_flight_stats[key]
+
+        while node.parent is not None:
+            node.virtual_visits += amount
+            node.parent.child_scores[node.index] -= amount
+            node.parent.child_visits[node.index] += amount
+            node = node.parent
+
+
+    def search(self, budget, C, progress = True, early_stop = None):
+        # budget: SearchBudget. Counts the leaves sent out, the results still running are waited for at the end.
+        # early_stop: None turns it on only for a timed budget (SearchBudget.timed)
+        if early_stop is None:
+            early_stop = budget.timed()
+        results = queue.Queue() # (child, score), filled by the pool's result thread
+        running = finished = 0
+        stopping = False
+
+        progress_bar = tqdm(total=budget.iterations, disable=not progress)
+        while running or not (stopping or self.root.proven is not None or (finished > 0 and budget.exhausted())):
+            if not running:
+                self.enforce_budget()
+
+            # Send out leaves until enough rollouts are running. Once the root is proven, only collect the rest.
+            # Over the node budget, the running rollouts are collected first so the tree can be pruned.
+            while not stopping and self.root.proven is None and not self.over_budget() and running < self.in_flight and (budget.done == 0 or not budget.exhausted()):
+                child = self.expansion(self.selection(self.root, C))
+                budget.tick()
+
+                transposition = child.visits > 0 and id(child.stats) not in self.in_flight_stats
+                if transposition or child.proven is not None or (self.solver is not None and self.solver.can_solve(child.state)):
+                    # Known result (transposition, end of the game or endgame solver): no rollout needed.
+                    # A position whose rollout is still in flight elsewhere gets its own.
+                    self.backpropagation(child, self.simulation(child))
+                    finished += 1
+                    progress_bar.update()
+                    continue
+
+                self.add_virtual_loss(child, self.virtual_loss)
+                self.pool.apply_async(rollout_worker, ((child.state, self.playouts),),
+                                      callback=lambda score, child=child: results.put((child, score)),
+                                      error_callback=results.put)
+                running += 1
+
+            if running:
+                result = results.get()
+                if isinstance(result, BaseException):
+                    raise result
+
+                child, score = result
+                running -= 1
+                self.add_virtual_loss(child, -self.virtual_loss)
+                self.backpropagation(child, score)
+                finished += 1
+                progress_bar.update()
+
+                if finished % 100 == 0:
+                    best_move = self.root.compute_best_score()[1]
+                    progress_bar.set_postfix({'Top Move': {o.move_name(best_move)}})
+
+                if early_stop and finished % DECIDED_CHECK_EVERY == 0 and budget.decided(root_visit_counts(self.root)):
+                    stopping = True # Collect the rollouts still running, send out no more
+
+        progress_bar.close()
+        return self.root.compute_best_score()
+
+def leaf_parallel_search(root, budget, C, playouts, solver, workers, pool = None, progress = True, early_stop = None,
+                         virtual_loss = 1, max_nodes = None):
+    '''
+    Leaf parallelization on the Board.Node tree of root, with `workers` processes running rollouts.
+    Two leaves per worker are kept in flight so no worker waits on the coordinator.
+    :param budget: SearchBudget for the search
+    :return: (child, move) like monte_carlo_tree_search
+    '''
+    if isinstance(root, ArrayNode):
+        raise ValueError('Leaf parallel search runs on Board.Node trees, not ArrayTree')
+
+    if pool is None:
+        with multiprocessing.Pool(workers) as pool:
+            tree = LeafParallelMonteCarlo(root, pool, playouts, solver, 2 * workers, virtual_loss, max_nodes)
+            return tree.search(budget, C, progress, early_stop)
+    tree = LeafParallelMonteCarlo(root, pool, playouts, solver, 2 * workers, virtual_loss, max_nodes)
+    return tree.search(budget, C, progress, early_stop)
+
+def leaf_parallel_report(iterations = 2000, workers = None, C = 2 ** .5, playouts = 1):
+    '''
+    How well leaf parallelization pays off on this machine: the same search from the start position, serial and
+    leaf parallel. The pool is started before timing, so only the search itself is measured.
+    :param workers: Processes for the parallel search, all cores if None
+    :return: Dict with iterations per second of both, speedup (parallel / serial) and efficiency (speedup / workers)
+    '''
+    workers = os.cpu_count() if workers is None else workers
+    solver = EndgameSolver(0, 0) # Rollouts only, so both searches do the same work per iteration
+
+    start = time.perf_counter()
+    monte_carlo_tree_search(None, iterations, C, playouts, None, solver, progress=False, early_stop=False)
+    serial = iterations / (time.perf_counter() - start)
+
+    with multiprocessing.Pool(workers) as pool:
+        start = time.perf_counter()
+        monte_carlo_tree_search(None, iterations, C, playouts, None, solver, workers=workers, parallel='leaf', pool=pool,
+                                progress=False, early_stop=False)
+        parallel = iterations / (time.perf_counter() - start)
+
+    speedup = parallel / serial
+    return {'workers': workers, 'serial_iterations_per_second': serial, 'parallel_iterations_per_second': parallel,
+            'speedup': speedup, 'efficiency': speedup / workers}
+
 
 if __name__ == '__main__':
     # Test Code running through 2 MCTS moves
-    white, black = 34628173824, 68853694464
+    state = GameState()
     node, move = monte_carlo_tree_search()
-    black, white = o.update_board(move, black, white)
-    o.disp_game(white, black, False)
+    state = state.play(move)
+    o.disp_game(state.white, state.black, False)
 
-    valid_moves = o.get_valid_move_list(white, black)
-    move = random.choice(valid_moves)
-    white, black = o.update_board(move, white, black)
-    o.disp_game(white, black, True)
+    move = o.random_bit(state.moves)
+    state = state.play(move)
+    o.disp_game(state.white, state.black, True)
 
     new_root = None
-    if move in node.available_moves:
+    if node.available_moves & o.SQUARE_MASKS[move]:
         new_root = node.make_child(move)
     else:
         for child in node.children:
@@ -152,5 +649,10 @@ if __name__ == '__main__':
                 break
 
     node, move = monte_carlo_tree_search(new_root)
-    black, white = o.update_board(move, black, white)
-    o.disp_game(white, black, False)
+    state = state.play(move)
+    o.disp_game(state.white, state.black, False)
+
+    report = leaf_parallel_report()
+    print(f'\nLeaf parallel, {report["workers"]} workers: {report["parallel_iterations_per_second"]:.0f} iterations/s against '
+          f'{report["serial_iterations_per_second"]:.0f} serial -> speedup {report["speedup"]:.2f}, '
+          f'efficiency {report["efficiency"]:.0%}')
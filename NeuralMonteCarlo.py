@@ -1,64 +1,253 @@
 import Othello as o
-import random
+import BatchOthello as bo
 import math
 import torch
+import TreeMemory as tm
+import Telemetry as tl
+from Board import random_argmax
+from TranspositionTable import Entry
+from Endgame import EndgameSolver
+from TimeControl import SearchBudget, DECIDED_CHECK_EVERY
+from GameState import GameState
 from AlphaZeroNetwork import AlphaZeroNet
 
 class NeuralMonteCarlo:
 
-    def __init__(self, network, white=34628173824, black=68853694464, turn_count=0, move_to_reach=-1):
-        self.root = Node(network, None, white, black, turn_count, move_to_reach)
+    def __init__(self, network, state=None, move_to_reach=-1, table=None, solver=None, max_nodes=None, telemetry=None,
+                 batch_size=1, virtual_loss=1, cache=None):
+        # table: Optional TranspositionTable. Can be kept across searches (e.g. one per game) as long as
+        # the network weights do not change: visit statistics are reset here, cached network outputs are kept.
+        # solver: EndgameSolver for the last empty squares. None creates a default one, EndgameSolver(0, 0) turns it off.
+        # max_nodes: Node budget for the tree. Past it, the subtrees of the least visited nodes are pruned (TreeMemory.prune).
+        # telemetry: Telemetry object to record the searches in (see Telemetry.py). Nodes are created and backpropagated
+        #   in one step here, so 'expansion' covers both, and the network calls are timed apart as 'inference'.
+        # batch_size: Leaves collected per run_simulation and evaluated in one forward pass (see run_batch)
+        # virtual_loss: Visits, all counted as losses, put on the path of every leaf waiting for its evaluation
+        # cache: EvaluationCache for the network outputs. Can be shared by any number of searches and games, it clears
+        #   itself when the network's weights change.
+        self.cache = cache
+        if cache is not None:
+            cache.check_network(network)
+
+        self.telemetry = telemetry
+        if telemetry is not None:
+            network = telemetry.instrument(network)
+
+        if table is not None:
+            table.reset_statistics()
+        self.solver = EndgameSolver() if solver is None else solver
+        self.table = table
+        self.root = Node(network, None, state, move_to_reach, table, self.solver, cache=cache)
         self.network = network
 
+        self.max_nodes = max_nodes
+        self.nodes = 1
+
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+        self.input_buffer = torch.empty((batch_size, 3, 8, 8)) # Network input of run_batch, reused every batch
+
         self.c_puct = 1 # Hyperparameter constant that affects exploration rate.
 
     def run_simulation(self):
         """
         Traverse the tree, guided by the PUCT score, and create a new node in the tree.
-        The tree is updated with the new simulation.
-        :return: None
+        The tree is updated with the new simulation. With batch_size > 1, this is run_batch instead.
+        :return: Number of nodes created
         """
+        if self.batch_size > 1:
+            return self.run_batch()
 
-        current_node = self.root
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.start()
 
-        # While we are in explored territory, follow the tree until current_node is at an unexplored point
-        while current_node.is_explored():
-            selected_child = 0
-            highest_PUCT = current_node.children[0].determine_PUCT(self.c_puct)
+        # Follow the tree until PUCT picks an edge that has no child yet
+        current_node = self.select_leaf()
+        if telemetry is not None:
+            telemetry.lap('selection')
 
-            for i in range(1, len(current_node.children)):
-                puct = current_node.children[i].determine_PUCT(self.c_puct)
+        # Create the child for that edge, the next untried move in prior order.
+        # Backpropagation is automatically performed via creating the node. (See Node init)
+        child = current_node.make_child(self.network)
+        if telemetry is not None:
+            telemetry.lap('expansion')
+            telemetry.leaf(tl.node_depth(child, self.root), int.bit_count(current_node.state.moves) or 1)
 
-                if puct > highest_PUCT:
-                    selected_child = i
-                    highest_PUCT = puct
+        self.add_nodes(1)
+        return 1
 
-            current_node = current_node.children[selected_child]
+    def run_batch(self):
+        """
+        Collect up to batch_size leaves, evaluate them in one forward pass, then create and backpropagate them.
+        collect_leaves and expand_leaves can also be called apart, to evaluate the leaves of several searches together.
+        :return: Number of nodes created
+        """
+        pending = self.collect_leaves()
+        states = [state for _, _, state, needed in pending if needed]
+        evaluations = evaluate_states(self.network, states, self.cache, self.input_buffer) if states else []
+        return self.expand_leaves(pending, iter(evaluations))
 
-        # We are now guaranteed to have unexplored moves. Create a new child at this node.
-        # Backpropagation is automatically performed via creating the node. (See Node init)
-        current_node.make_child(self.network)
+    def collect_leaves(self):
+        """
+        Select up to batch_size leaves. The edge of every leaf is claimed right away (Node.claim_edge) and gets a
+        virtual loss on its path, so the next selections spread over other branches instead of all walking down to
+        the same edge. Leaves whose evaluation is already known (transposition or endgame solver) skip the network.
+        :return: Pending leaves for expand_leaves, as (node, edge index, state of the child, evaluation needed)
+        """
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.start()
+
+        pending = []
+        for _ in range(self.batch_size):
+            node = self.select_leaf()
+            if node is None:
+                break # The way down ends in an edge that is already waiting
+
+            index, move = node.claim_edge()
+            state = node.state.play(move)
+            node.add_virtual_loss(self.virtual_loss, index)
+            pending.append((node, index, state, not node.knows_evaluation(move, state)))
+        if telemetry is not None:
+            telemetry.lap('selection')
+
+        return pending
+
+    def expand_leaves(self, pending, evaluations):
+        """
+        Create and backpropagate the leaves from collect_leaves, in the order their edges were claimed, which keeps
+        them in line with their parents' edge lists.
+        :param evaluations: Iterator over the (move priors, value) of the leaves that needed the network, in order.
+            Only this search's share is taken from it.
+        :return: Number of nodes created
+        """
+        created = []
+        for node, index, _, needed in pending:
+            node.add_virtual_loss(-self.virtual_loss, index)
+            created.append(node.make_child(self.network, evaluation=next(evaluations) if needed else None))
+
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.lap('expansion')
+            for child in created:
+                telemetry.leaf(tl.node_depth(child, self.root), int.bit_count(child.parent.state.moves) or 1)
+
+        self.add_nodes(len(created))
+        return len(created)
+
+    def select_leaf(self):
+        # Follow PUCT down to the node whose next unclaimed edge wins the selection. None if the way down picks an
+        # edge that is claimed but still waiting for its child (only while a batch is being collected).
+        node = self.root
+        while True:
+            index = node.select_edge(self.c_puct)
+            if index == len(node.child_visits):
+                return node
+            if index >= len(node.children):
+                return None
+            node = node.children[index]
+
+    def add_nodes(self, count):
+        # Count new nodes against the node budget, pruning once it is exceeded. Only between steps.
+        self.nodes += count
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            self.root, self.nodes = tm.prune(self.root, self.max_nodes)
+
+    def advance(self, move):
+        """
+        Move the root forward by a played move, ours or the opponent's, so the next search starts from the subtree
+        that is already there. Its statistics and network evaluations are kept, the rest of the tree is freed.
+        A move without a child gets a new root. The transposition table, if any, keeps its statistics too.
+        :return: The new root
+        """
+        child = next((child for child in self.root.children if child.move_to_reach == move), None)
+        if child is None:
+            child = Node(self.network, None, self.root.state.play(move), move, self.table, self.solver, cache=self.cache)
+
+        self.root = tm.detach(child)
+        self.nodes = tm.count_nodes(self.root)
+        self.add_nodes(0) # The subtree can still be over the node budget
+        return self.root
+
+    def top_up(self, visits):
+        # Run iterations until the root has visits visits, counting those kept from earlier searches (see advance).
+        # Always at least one, so there is a move to play.
+        self.run_iterations(max(1, visits - self.root.visits))
 
     def run_iterations(self, num_its):
-        for i in range(num_its):
-            self.run_simulation()
+        # num_its: Nodes to create. With batching, the last step is cut short so no more are made.
+        if self.telemetry is not None:
+            self.telemetry.begin()
+
+        batch_size = self.batch_size
+        done = 0
+        while done < num_its:
+            self.batch_size = min(batch_size, num_its - done)
+            done += self.run_simulation()
+        self.batch_size = batch_size
+
+        if self.telemetry is not None:
+            self.telemetry.end(self.root)
+
+    def run(self, iterations=None, time_limit=None, stop=None, early_stop=None):
+        """
+        Anytime search: run simulations until the first of the limits is hit, then get_move_to_play
+        gives the best move found so far. At least one simulation is run.
+        :param iterations: Maximum number of simulations, None for no limit
+        :param time_limit: Milliseconds to search for, None for no limit
+        :param stop: threading.Event that ends the search when set
+        :param early_stop: End as soon as the most visited root move can no longer be overtaken.
+            None turns it on only with a time_limit or stop, so a fixed number of simulations is always run in full.
+        :return: Number of simulations run
+        """
+        budget = SearchBudget(iterations, time_limit, stop) # Raises if no limit is given
+        if early_stop is None:
+            early_stop = budget.timed()
+
+        if self.solver.can_solve_root(self.root.state):
+            return 0 # get_move_to_play solves the position, no search needed
+
+        if self.telemetry is not None:
+            self.telemetry.begin()
+
+        batch_size = self.batch_size
+        next_check = DECIDED_CHECK_EVERY
+        while budget.done == 0 or not budget.exhausted():
+            if iterations is not None:
+                self.batch_size = min(batch_size, iterations - budget.done)
+            budget.tick(self.run_simulation())
+
+            if early_stop and budget.done >= next_check:
+                next_check = budget.done + DECIDED_CHECK_EVERY
+                if budget.decided(self.root_visit_counts()):
+                    break
+        self.batch_size = batch_size
+
+        if self.telemetry is not None:
+            self.telemetry.end(self.root)
+
+        return budget.done
+
+    def root_visit_counts(self):
+        # Visits of every root move, 0 for the moves whose edge is not claimed yet (see SearchBudget.decided)
+        return self.root.child_visits + [0] * (len(self.root.edge_moves) - len(self.root.child_visits))
 
     def get_root_visit_distribution(self):
         """
         Return the probability distribution corresponding to how often
-        every child of the root was visited.
+        every move of the root was visited. Counted on the root's edges (child_visits), not the children's
+        statistics: with a transposition table those also hold the visits a position got through other paths.
         :return: A dictionary of (move, probability) pairs. -1 (pass) is moved to token 64
         """
-        N = self.root.visits
+        N = sum(self.root.child_visits) or 1
         dist = {}
 
-        for child in self.root.children:
-            child_move = child.move_to_reach
-
-            if child_move != -1:
-                dist[child_move] = child.visits / N
+        for move, visits in zip(self.root.edge_moves, self.root.child_visits):
+            if move != -1:
+                dist[move] = visits / N
             else:
-                dist[64] = child.visits / N
+                dist[64] = visits / N
 
         return dist
 
@@ -68,130 +257,266 @@ class NeuralMonteCarlo:
         :return:
         """
 
-        # The best move has the most visits
-        most_moves_dex = 0
-        most_moves = self.root.children[0].visits
-
-        for i in range(1, len(self.root.children)):
-            if self.root.children[i].visits > most_moves:
-                most_moves_dex = i
-                most_moves = self.root.children[i].visits
-
-        return self.root.children[most_moves_dex].move_to_reach
-
+        # Few enough empty squares -> play perfectly
+        if self.solver.can_solve_root(self.root.state):
+            return self.solver.best_move(self.root.state.player, self.root.state.opponent)[0]
+
+        # The best move has the most visits through the root's own edges. Nothing searched yet -> highest prior.
+        child_visits = self.root.child_visits
+        if not child_visits:
+            return self.root.edge_moves[0]
+        return self.root.edge_moves[max(range(len(child_visits)), key=child_visits.__getitem__)]
+
+
+def move_priors(logits, available_moves):
+    """
+    Softmax of the network's policy over the legal moves only.
+    :param logits: Policy output for one position, 65 values (64 = pass)
+    :param available_moves: Bitboard of the legal moves, o.PASS_MASK if the player has to pass
+    :return: Look-up table of move -> prior probability over the legal moves, -1 for a pass
+    """
+    legal_moves = list(o.iterate_bits(available_moves))
+    dist = torch.softmax(logits[legal_moves], dim=0).tolist()
+    return {move if move != 64 else -1: probability for move, probability in zip(legal_moves, dist)}
+
+def evaluate_states(network, states, cache=None, buffer=None):
+    """
+    Run the network on several positions in one forward pass.
+    :param cache: EvaluationCache. Cached positions skip the network, the others are added to it.
+    :param buffer: Preallocated input tensor to encode the positions into (see encode_boards)
+    :return: (move priors, value) of every state, like Node.evaluate
+    """
+    outputs = [None] * len(states) # (logits, value) of every state
+    missing = list(range(len(states)))
+    if cache is not None:
+        for i, state in enumerate(states):
+            outputs[i] = cache.get(state)
+        missing = [i for i in missing if outputs[i] is None]
+
+    if missing:
+        batch = encode_states([states[i] for i in missing], buffer)
+        with torch.no_grad():
+            p, v = network(batch)
+
+        for i, logits, value in zip(missing, p, v.tolist()):
+            outputs[i] = (logits, value)
+            if cache is not None:
+                cache.put(states[i], logits, value)
+
+    return [(move_priors(logits, state.moves or o.PASS_MASK), value) for (logits, value), state in zip(outputs, states)]
+
+def encode_boards(boards, out=None):
+    """
+    Shared input encoder: unpack bitboards into float planes, square 8*row + column at [row, column].
+    :param boards: N rows of C bitboards (nested lists of ints or a uint64 array), one row per position
+    :param out: Preallocated float tensor with room for at least N positions of C planes. Filled and reused instead of
+        allocating a new tensor, so only give it when the previous contents are no longer needed.
+    :return: Tensor of size N x C x 8 x 8 (a view of out if given)
+    """
+    planes = torch.from_numpy(bo.unpack_boards(boards))
+    if out is None:
+        return planes.float()
+
+    out = out[:len(planes)]
+    out.copy_(planes)
+    return out
+
+def encode_positions(players, opponents, moves, out=None):
+    """
+    Network input of several positions: the pieces of the side to move, the opponent's pieces and the legal moves.
+    :return: Tensor of size N x 3 x 8 x 8
+    """
+    return encode_boards(list(zip(players, opponents, moves)), out)
+
+def encode_states(states, out=None):
+    # encode_positions for GameStates, whose legal moves are usually already known
+    return encode_boards([(state.player, state.opponent, state.moves) for state in states], out)
 
 # Convert board state into a tensor of size 1 x 3 x 8 x 8
-def board_state_to_tensor(white, black, turn_count):
+def board_state_to_tensor(white, black, turn_count, out=None):
     if turn_count % 2 == 0:
         player, opponent = black, white
     else:
         player, opponent = white, black
 
     possible_moves = o.advanced_gen_moves(player, opponent)
-
-    t = torch.zeros((1,3,8,8))
-
-    for i in range(8):
-        for j in range(8):
-            if o.read_bit(player, i*8+j):
-                t[0,0,i,j] = 1
-            elif o.read_bit(opponent, i*8+j):
-                t[0,1,i,j] = 1
-            elif o.read_bit(possible_moves, i*8+j):
-                t[0,2,i,j] = 1
-
-    return t
+    return encode_boards([(player, opponent, possible_moves)], out)
 
 class Node:
 
-    def __init__(self, network, parent=None, white=34628173824, black=68853694464, turn_count=0, move_to_reach=-1):
+    def __init__(self, network, parent=None, state=None, move_to_reach=-1, table=None, solver=None, index=0,
+                 evaluation=None, cache=None):
         # Properties relevant to a node of a monte carlo tree
         self.parent = parent
         self.children = []
-
-        self.visits = 0
-        self.score = 0
+        self.index = index # Position in parent.children
 
         # Properties of the current Othello game state
-        self.white = white
-        self.black = black
-        self.turn_count = turn_count
+        self.state = GameState() if state is None else state
         self.move_to_reach = move_to_reach # What move created this Node?
 
-        # Note: When true, black is to play. When false, white is to play
-        self.to_play = turn_count % 2 == 0
-
-        if self.to_play:
-            self.available_moves = o.get_valid_move_list(black, white)
-        else:
-            self.available_moves = o.get_valid_move_list(white, black)
-
-        if len(self.available_moves) == 0:
-            self.available_moves.append(-1)  # Pass token
+        # Visits, score and the network evaluation live in an Entry, shared between transpositions when there is a table.
+        # Roots and nodes reached by a pass keep their own: after two passes the position repeats its grandparent.
+        self.table = table
+        self.stats = Entry()
+        if table is not None:
+            key = self.state.key # Known from here on, so the children's hashes are updated incrementally
+            if move_to_reach != -1:
+                self.stats = table.lookup(key)
+
+        # Bitboard of the moves whose edge has not been claimed yet. Bit 64 (o.PASS_MASK) is the pass token.
+        self.available_moves = self.state.moves
+        if self.available_moves == 0:
+            self.available_moves = o.PASS_MASK  # Pass token
+
+        # The tree is stored as edges on the parent: every legal move with its prior, sorted by prior (edge_moves,
+        # child_priors), and the visits / score of the claimed edges so far (child_visits, child_scores). Children are
+        # only created when PUCT selects their edge, always the best untried one, so the claimed edges are the first
+        # len(child_visits) and self.children[i] belongs to edge i once it exists.
+        self.child_visits = []
+        self.child_scores = []
 
         # ---------------------- Built-in Backpropagation (Since we need to evaluate probabilities)
-        # Get predictions from the network
-        p, v = network(board_state_to_tensor(white, black, turn_count))
+        # Get predictions from the network, unless a transposition already did or they come from a batch (evaluation).
+        # Near the end, solve exactly instead. The cache (EvaluationCache) saves the forward pass for positions seen before.
+        self.solver = solver
+        self.cache = cache
+        if self.stats.evaluation is None:
+            if evaluation is None:
+                if solver is not None and solver.can_solve(self.state):
+                    evaluation = self.solve(solver)
+                else:
+                    evaluation = self.evaluate(network)
+            self.stats.evaluation = evaluation
+        self.probabilities, value = self.stats.evaluation
+        self.edge_moves = sorted(self.probabilities, key=self.probabilities.get, reverse=True)
+        self.child_priors = [self.probabilities[move] for move in self.edge_moves]
 
         # Backpropagate value through the tree
-        value = v[0].item()
         if self.parent is not None:
             self.parent.backpropogate(value) # We start with parent since we haven't visited this node - only created it.
 
-        # Translate p to only include probabilities for valid moves
-        mask = [False] * 65
-        for move in self.available_moves:
-            if move != -1:
-                mask[move] = True
-            else:
-                mask[64] = True
-        mask_t = torch.tensor(mask, dtype=torch.bool)
+    @property
+    def visits(self):
+        return self.stats.visits
 
-        p = p[0]
-        p[~mask_t] = -1e9 # Mask illegal moves with large negative coefficient. Goes to 0 in softmax.
-        dist = torch.softmax(p, dim=0)
+    @visits.setter
+    def visits(self, visits):
+        self.stats.visits = visits
 
-        # Look-up table for the probability to make a certain action, based on the network.
-        self.probabilities = {}
-        for i in range(len(self.available_moves)):
-            move = self.available_moves[i]
-
-            if move != -1:
-                self.probabilities[move] = dist[move].item()
-            else:
-                self.probabilities[move] = dist[64].item()
+    @property
+    def score(self):
+        return self.stats.score
 
+    @score.setter
+    def score(self, score):
+        self.stats.score = score
 
+    def evaluate(self, network):
+        """
+        Run the network on this node's position.
+        :return: (Look-up table of move -> prior probability over the legal moves, value)
+        """
+        return evaluate_states(network, [self.state], self.cache)[0]
 
-    def is_explored(self):
-        return len(self.available_moves) == 0
+    def solve(self, solver):
+        """
+        Exact replacement for evaluate: the game result for the player to move, with uniform priors over the legal moves.
+        :return: (Look-up table of move -> prior probability over the legal moves, value)
+        """
+        value = float(solver.solve_winner(self.state.player, self.state.opponent))
 
-    def make_child(self, network, move = None):
-        if move is None: move = random.choice(self.available_moves)
+        legal_moves = [move if move != 64 else -1 for move in o.iterate_bits(self.available_moves)]
+        probabilities = {move: 1 / len(legal_moves) for move in legal_moves}
 
-        if move != -1:
-            if self.to_play:
-                new_black, new_white = o.update_board(move, self.black, self.white)
-            else:
-                new_white, new_black = o.update_board(move, self.white, self.black)
-        else:
-            # Pass -> boards unchanged
-            new_black, new_white = self.white, self.black
+        return probabilities, value
 
-        self.available_moves.remove(move)
+    def is_explored(self):
+        # Every edge has been claimed
+        return self.available_moves == 0
+
+    def knows_evaluation(self, move, state):
+        # True if the child for move would not need the network: a transposition already has it, or the solver takes over
+        if self.solver is not None and self.solver.can_solve(state):
+            return True
+        if self.table is None or move == -1:
+            return False
+        entry = self.table.entries.get(state.key)
+        return entry is not None and entry.evaluation is not None
+
+    def add_result(self, score, visits=1):
+        # Add to this node's statistics, and to the parent's lists for this child (Board.Node.add_result)
+        self.stats.score += score
+        self.stats.visits += visits
+        if self.parent is not None:
+            self.parent.child_scores[self.index] += score
+            self.parent.child_visits[self.index] += visits
+
+    def add_virtual_loss(self, amount, index=None):
+        # amount visits that all count as losses, on this node and every node above it, and on the claimed edge index
+        # if given. Negative amounts take it back.
+        if index is not None:
+            self.child_scores[index] -= amount
+            self.child_visits[index] += amount
+        node = self
+        while node is not None:
+            node.add_result(-amount, amount)
+            node = node.parent
+
+    def clear_children(self):
+        # Drop the subtree under this node (TreeMemory.prune). Its statistics and network evaluation stay, and its
+        # moves are expanded again if the search comes back to it.
+        for child in self.children:
+            child.parent = None
+        self.children = []
+        self.child_visits = []
+        self.child_scores = []
+        self.available_moves = self.state.moves or o.PASS_MASK
 
-        child = Node(network, self, new_white, new_black, self.turn_count + 1, move)
+    def claim_edge(self):
+        """
+        Take the next untried edge, the one with the highest prior, and open its statistics slot.
+        :return: (edge index, move)
+        """
+        index = len(self.child_visits)
+        move = self.edge_moves[index]
+        self.available_moves &= ~o.SQUARE_MASKS[move]
+        self.child_visits.append(0)
+        self.child_scores.append(0)
+        return index, move
+
+    def make_child(self, network, evaluation = None):
+        # Create the child of the first claimed edge without one, claiming the next edge if there is none.
+        # The child's slot has to exist before the child is created, since creating it backpropagates.
+        index = len(self.children)
+        if index == len(self.child_visits):
+            self.claim_edge()
+        move = self.edge_moves[index]
+
+        child = Node(network, self, self.state.play(move), move, self.table, self.solver, index, evaluation, self.cache)
         self.children.append(child)
 
         return child
 
     def backpropogate(self, value):
-        self.score += value
-        self.visits += 1
+        self.add_result(value)
 
         if self.parent is not None:
             self.parent.backpropogate(-value)
 
+    def select_edge(self, c):
+        """
+        determine_PUCT for all claimed edges in one pass over the lists, plus the next unclaimed one. Unvisited edges
+        score explore * prior and the edges are sorted by prior, so no later edge can beat the next one.
+        :return: Index of the selected edge, len(self.child_visits) for the next unclaimed edge
+        """
+        explore = c * math.sqrt(self.visits)
+        puct = [(score / visits if visits > 0 else 0) + explore * prior / (1 + visits)
+                for score, visits, prior in zip(self.child_scores, self.child_visits, self.child_priors)]
+        if len(puct) < len(self.child_priors):
+            puct.append(explore * self.child_priors[len(puct)])
+        return random_argmax(puct)
+
     def determine_PUCT(self, c):
         q = 0
         if self.visits > 0:
@@ -1,3 +1,5 @@
+import random
+
 def set_bit(b, dex):
     return b | (1 << dex)
 def read_bit(b, dex):
@@ -18,7 +20,9 @@ def shift_boards(boards):
     boards[7] = (boards[7] << 9) & 18374403900871474942
 
 
-def advanced_gen_moves(player, opponent):
+# Original list-based move generator. Kept as the reference for compare_gen_moves.
+
+def naive_gen_moves(player, opponent):
     # Write a less-generalized, more optimized version of generating moves that cuts out a lot of repeated calculations.
     valid_moves = 0
 
@@ -52,10 +56,138 @@ def advanced_gen_moves(player, opponent):
     return valid_moves & ~(player | opponent)
 
 
+# Flip engine: for every direction, flood the move through contiguous opponent pieces with whole-board
+# shift + mask operations and keep the run if the square after it holds a player piece.
+# Same shift + edge-mask conventions as shift_boards. Unrolled because loops over the directions are
+# noticeably slower in Python, and the fill stops as soon as the run ends (most directions stop at step one).
+FULL = 18446744073709551615
+NOT_A_FILE = 18374403900871474942 # Clears column 0 (A) -> use after shifting towards higher columns
+NOT_H_FILE = 9187201950435737471 # Clears column 7 (H) -> use after shifting towards lower columns
+
+def flip_mask(move_dex, player, opponent):
+    move = 1 << move_dex
+    flips = 0
+
+    # Directions that cannot wrap into column 0: [1, 9, -7]
+    pro = opponent & NOT_A_FILE
+    run = (move << 1) & pro
+    if run:
+        front = (run << 1) & pro
+        while front: run |= front; front = (front << 1) & pro
+        if (run << 1) & NOT_A_FILE & player: flips |= run
+    run = (move << 9) & pro
+    if run:
+        front = (run << 9) & pro
+        while front: run |= front; front = (front << 9) & pro
+        if (run << 9) & NOT_A_FILE & player: flips |= run
+    run = (move >> 7) & pro
+    if run:
+        front = (run >> 7) & pro
+        while front: run |= front; front = (front >> 7) & pro
+        if (run >> 7) & NOT_A_FILE & player: flips |= run
+
+    # Directions that cannot wrap into column 7: [-1, -9, 7]
+    pro = opponent & NOT_H_FILE
+    run = (move >> 1) & pro
+    if run:
+        front = (run >> 1) & pro
+        while front: run |= front; front = (front >> 1) & pro
+        if (run >> 1) & NOT_H_FILE & player: flips |= run
+    run = (move >> 9) & pro
+    if run:
+        front = (run >> 9) & pro
+        while front: run |= front; front = (front >> 9) & pro
+        if (run >> 9) & NOT_H_FILE & player: flips |= run
+    run = (move << 7) & pro
+    if run:
+        front = (run << 7) & pro
+        while front: run |= front; front = (front << 7) & pro
+        if (run << 7) & NOT_H_FILE & player: flips |= run
+
+    # Vertical directions never wrap: [8, -8]
+    run = (move << 8) & opponent
+    if run:
+        front = (run << 8) & opponent
+        while front: run |= front; front = (front << 8) & opponent
+        if (run << 8) & player: flips |= run
+    run = (move >> 8) & opponent
+    if run:
+        front = (run >> 8) & opponent
+        while front: run |= front; front = (front >> 8) & opponent
+        if (run >> 8) & player: flips |= run
+
+    return flips
+
+def update_board(move_dex, player, opponent):
+    flips = flip_mask(move_dex, player, opponent)
+
+    # Return updated bitboards
+    return player | flips | (1 << move_dex), opponent & ~flips
+
+def advanced_gen_moves(player, opponent):
+    # Same run fill as flip_mask, started from every player piece at once. A run of opponent pieces
+    # followed by an empty square makes that square a legal move.
+    moves = 0
+
+    # Directions that cannot wrap into column 0: [1, 9, -7]
+    pro = opponent & NOT_A_FILE
+    run = (player << 1) & pro
+    if run:
+        front = (run << 1) & pro
+        while front: run |= front; front = (front << 1) & pro
+        moves |= run << 1
+    run = (player << 9) & pro
+    if run:
+        front = (run << 9) & pro
+        while front: run |= front; front = (front << 9) & pro
+        moves |= run << 9
+    run = (player >> 7) & pro
+    if run:
+        front = (run >> 7) & pro
+        while front: run |= front; front = (front >> 7) & pro
+        moves |= run >> 7
+    moves &= NOT_A_FILE
+
+    # Directions that cannot wrap into column 7: [-1, -9, 7]
+    h_moves = 0
+    pro = opponent & NOT_H_FILE
+    run = (player >> 1) & pro
+    if run:
+        front = (run >> 1) & pro
+        while front: run |= front; front = (front >> 1) & pro
+        h_moves |= run >> 1
+    run = (player >> 9) & pro
+    if run:
+        front = (run >> 9) & pro
+        while front: run |= front; front = (front >> 9) & pro
+        h_moves |= run >> 9
+    run = (player << 7) & pro
+    if run:
+        front = (run << 7) & pro
+        while front: run |= front; front = (front << 7) & pro
+        h_moves |= run << 7
+    moves |= h_moves & NOT_H_FILE
+
+    # Vertical directions never wrap: [8, -8]
+    run = (player << 8) & opponent
+    if run:
+        front = (run << 8) & opponent
+        while front: run |= front; front = (front << 8) & opponent
+        moves |= run << 8
+    run = (player >> 8) & opponent
+    if run:
+        front = (run >> 8) & opponent
+        while front: run |= front; front = (front >> 8) & opponent
+        moves |= run >> 8
+
+    return moves & ~(player | opponent) & FULL
+
+
+# Original square-by-square version of update_board. Kept as the reference for compare_update_board.
 # Note: We don't really need bitboard operations here since we're not keeping track of how the entire board is changing.
 # Just using bit shift operations to read bits.
 
-def update_board(move_dex, player, opponent):
+def naive_update_board(move_dex, player, opponent):
     # First, update player board with the move.
     player = set_bit(player, move_dex)
 
@@ -88,19 +220,186 @@ def update_board(move_dex, player, opponent):
     # Return updated bitboards
     return player, opponent
 
-# Now I just need a way to index the valid moves...
-def get_valid_move_list(player, opponent):
-    move_b = advanced_gen_moves(player, opponent)
-
-    moves = []
-    translated = move_b
-    for i in range(64): # Check every bit on the board - starting with the greatest index
-        if translated & 1 == 1:
-            moves.append(i)
+# Per-square look-up tables, shared by everything that converts between indices, bits and board names.
+# SQUARE_MASKS has a 65th entry for the pass token, so SQUARE_MASKS[-1] (pass) and SQUARE_MASKS[64] are the same bit.
+PASS_MASK = 1 << 64
+SQUARE_MASKS = [1 << i for i in range(64)] + [PASS_MASK]
+SQUARE_COORDS = [(i // 8, i % 8) for i in range(64)] # (row, column)
+SQUARE_NAMES = [f'{chr(i % 8 + 65)}{i // 8 + 1}' for i in range(64)]
+SQUARE_INDEX = {name: i for i, name in enumerate(SQUARE_NAMES)}
+
+def move_name(move):
+    return SQUARE_NAMES[move] if 0 <= move < 64 else 'pass'
+
+def iterate_bits(b):
+    # Yields the index of every set bit, lowest first. Only loops once per set bit.
+    while b:
+        low = b & -b
+        yield low.bit_length() - 1
+        b ^= low
+
+def nth_bit(b, k):
+    # Index of the k-th (0-based, counting from the lowest) set bit of b.
+    for _ in range(k):
+        b &= b - 1
+    return (b & -b).bit_length() - 1
+
+def random_bit(b, rng=random):
+    # Uniformly random set bit of b, picked straight from the bitboard. b must be non-zero.
+    return nth_bit(b, rng.randrange(int.bit_count(b)))
 
-        translated = translated >> 1
-
-    return moves
+def get_valid_move_list(player, opponent):
+    return list(iterate_bits(advanced_gen_moves(player, opponent)))
+
+# Zobrist hashing. One random key per (square, color), plus a key XORed in when black is to play.
+# Fixed seed, so hashes are the same in every process and every run.
+_zobrist_rng = random.Random(20240131)
+ZOBRIST_WHITE = [_zobrist_rng.getrandbits(64) for _ in range(64)]
+ZOBRIST_BLACK = [_zobrist_rng.getrandbits(64) for _ in range(64)]
+ZOBRIST_SIDE = _zobrist_rng.getrandbits(64)
+
+def _zobrist_byte_tables(keys):
+    # tables[k][v] = XOR of the keys of the set bits of byte value v, placed at byte k of the board
+    return [[_xor_keys(keys, 8 * k, v) for v in range(256)] for k in range(8)]
+
+def _xor_keys(keys, offset, byte):
+    h = 0
+    for i in iterate_bits(byte):
+        h ^= keys[offset + i]
+    return h
+
+ZOBRIST_WHITE_BYTES = _zobrist_byte_tables(ZOBRIST_WHITE)
+ZOBRIST_BLACK_BYTES = _zobrist_byte_tables(ZOBRIST_BLACK)
+ZOBRIST_FLIP_BYTES = _zobrist_byte_tables([w ^ b for w, b in zip(ZOBRIST_WHITE, ZOBRIST_BLACK)]) # Piece changes color
+
+def zobrist_board(b, tables):
+    h = 0
+    for k in range(8):
+        h ^= tables[k][(b >> 8 * k) & 255]
+    return h
+
+def zobrist_hash(white, black, black_to_play):
+    h = zobrist_board(white, ZOBRIST_WHITE_BYTES) ^ zobrist_board(black, ZOBRIST_BLACK_BYTES)
+    return h ^ ZOBRIST_SIDE if black_to_play else h
+
+def update_hash(h, move_dex, flips, black_moved):
+    """
+    Incremental zobrist_hash after a move: the placed piece, the flipped pieces and the side to move change.
+    :param move_dex: Square played, or -1 for a pass (only the side to move changes)
+    :param flips: Flip mask of the move (see flip_mask)
+    """
+    if move_dex == -1:
+        return h ^ ZOBRIST_SIDE
+
+    placed = ZOBRIST_BLACK[move_dex] if black_moved else ZOBRIST_WHITE[move_dex]
+    return h ^ placed ^ zobrist_board(flips, ZOBRIST_FLIP_BYTES) ^ ZOBRIST_SIDE
+
+# Board symmetries. Symmetry s (0-7) mirrors the columns if s & 1, then the rows if s & 2, then
+# transposes (swaps rows and columns) if s & 4. Together these are all 8 rotations / reflections of the board.
+def flip_horizontal(b):
+    # Mirror the columns (A <-> H): reverse the bits of every byte
+    b = ((b >> 1) & 0x5555555555555555) | ((b & 0x5555555555555555) << 1)
+    b = ((b >> 2) & 0x3333333333333333) | ((b & 0x3333333333333333) << 2)
+    return ((b >> 4) & 0x0F0F0F0F0F0F0F0F) | ((b & 0x0F0F0F0F0F0F0F0F) << 4)
+
+def flip_vertical(b):
+    # Mirror the rows (1 <-> 8): reverse the byte order
+    return int.from_bytes(b.to_bytes(8, 'little'), 'big')
+
+def flip_diagonal(b):
+    # Transpose along the A1-H8 diagonal (row <-> column) with delta swaps
+    t = 0x0F0F0F0F00000000 & (b ^ (b << 28))
+    b ^= t ^ (t >> 28)
+    t = 0x3333000033330000 & (b ^ (b << 14))
+    b ^= t ^ (t >> 14)
+    t = 0x5500550055005500 & (b ^ (b << 7))
+    return b ^ t ^ (t >> 7)
+
+def transform_board(b, symmetry):
+    if symmetry & 1: b = flip_horizontal(b)
+    if symmetry & 2: b = flip_vertical(b)
+    if symmetry & 4: b = flip_diagonal(b)
+    return b
+
+def _transform_square(i, symmetry):
+    row, col = SQUARE_COORDS[i]
+    if symmetry & 1: col = 7 - col
+    if symmetry & 2: row = 7 - row
+    if symmetry & 4: row, col = col, row
+    return 8 * row + col
+
+# SYMMETRY_MOVES[s][move] = move in the frame of symmetry s. The pass token (64, or -1) maps to itself.
+SYMMETRY_MOVES = [[_transform_square(i, s) for i in range(64)] + [64] for s in range(8)]
+# INVERSE_SYMMETRY[s] undoes symmetry s
+INVERSE_SYMMETRY = [next(t for t in range(8) if all(SYMMETRY_MOVES[t][SYMMETRY_MOVES[s][i]] == i for i in range(64)))
+                    for s in range(8)]
+
+def transform_move(move, symmetry):
+    return SYMMETRY_MOVES[symmetry][move] if move != -1 else -1
+
+def canonical_board(b):
+    """
+    Smallest of the 8 symmetric versions of a board.
+    :return: (canonical board, symmetry that maps b onto it)
+    """
+    return min((transform_board(b, s), s) for s in range(8))
+
+def canonical_position(player, opponent):
+    """
+    Canonical form of a position: the symmetry whose (player, opponent) pair is smallest.
+    Map moves into the canonical frame with transform_move(move, s), and back with transform_move(move, INVERSE_SYMMETRY[s]).
+    :return: (player, opponent, s)
+    """
+    best = None
+    for s in range(8):
+        candidate = (transform_board(player, s), transform_board(opponent, s), s)
+        if best is None or candidate < best:
+            best = candidate
+    return best
+
+def compare_update_board(num_positions=100000, seed=None):
+    """
+    Differential check of update_board against naive_update_board on random positions.
+    Every empty square is tried as a move, legal or not, so the edge handling gets exercised too.
+    :return: Number of (position, move) pairs compared. Raises AssertionError on the first mismatch.
+    """
+    rng = random.Random(seed)
+    compared = 0
+
+    for _ in range(num_positions):
+        occupied = rng.getrandbits(64) | rng.getrandbits(64) # ~75% of the board filled
+        player = occupied & rng.getrandbits(64)
+        opponent = occupied & ~player
+
+        empty = ~occupied & FULL
+        while empty:
+            move = empty & -empty
+            empty ^= move
+            move_dex = move.bit_length() - 1
+
+            expected = naive_update_board(move_dex, player, opponent)
+            actual = update_board(move_dex, player, opponent)
+            assert actual == expected, f'update_board mismatch: move {move_dex}, player {player}, opponent {opponent}'
+            compared += 1
+
+    return compared
+
+def compare_gen_moves(num_positions=100000, seed=None):
+    """
+    Differential check of advanced_gen_moves against naive_gen_moves on random positions.
+    :return: Number of positions compared. Raises AssertionError on the first mismatch.
+    """
+    rng = random.Random(seed)
+
+    for _ in range(num_positions):
+        occupied = rng.getrandbits(64) | rng.getrandbits(64)
+        player = occupied & rng.getrandbits(64)
+        opponent = occupied & ~player
+
+        expected = naive_gen_moves(player, opponent)
+        assert advanced_gen_moves(player, opponent) == expected, f'advanced_gen_moves mismatch: player {player}, opponent {opponent}'
+
+    return num_positions
 
 def disp_game(white, black, blacks_move):
     if blacks_move: moves = advanced_gen_moves(black, white)
@@ -158,4 +457,7 @@ if __name__ == '__main__':
 
     disp_game(white, black, True)
     print()
-    disp_game(white, black, False)
\ No newline at end of file
+    disp_game(white, black, False)
+
+    print(f'\nupdate_board matches naive_update_board on {compare_update_board(seed=0)} moves')
+    print(f'advanced_gen_moves matches naive_gen_moves on {compare_gen_moves(seed=0)} positions')
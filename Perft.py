@@ -0,0 +1,151 @@
+import random
+import time
+import Othello as o
+from GameState import GameState
+
+"""
+Perft: count the leaves of the full game tree to a fixed depth. The counts only come out right if
+move generation and flipping are both exact, so this is the correctness check and the speed baseline
+for the bitboard functions in Othello.py (advanced_gen_moves + update_board).
+
+Conventions (same as the published Othello perft numbers):
+    - A pass is a ply: a side without moves passes, and that counts as one node.
+    - A finished game (neither side can move) before the full depth counts as a single leaf.
+    - The last ply is bulk counted: the number of legal moves is the number of leaves, without playing them.
+"""
+
+# Published leaf counts from the start position
+START_PERFT = {
+    1: 4,
+    2: 12,
+    3: 56,
+    4: 244,
+    5: 1396,
+    6: 8200,
+    7: 55092,
+    8: 390216,
+    9: 3005288,
+    10: 24571284,
+    11: 212258800,
+    12: 1939886636,
+    13: 18429641748,
+    14: 184042084512,
+}
+
+
+def perft(player, opponent, depth, passed=False, gen_moves=o.advanced_gen_moves, update=o.update_board):
+    """
+    :param player: Board of the side to move
+    :param opponent: Board of the other side
+    :param depth: Plies to search, at least 1
+    :param passed: True if the previous ply was a pass (a second pass ends the game)
+    :param gen_moves: Move generator to test, (player, opponent) -> moves bitboard
+    :param update: Move function to test, (move_dex, player, opponent) -> (player, opponent)
+    :return: Number of leaves at depth
+    """
+    moves = gen_moves(player, opponent)
+    if moves == 0:
+        if passed or depth == 1: # Game over, or the pass is the last ply
+            return 1
+        return perft(opponent, player, depth - 1, True, gen_moves, update)
+
+    if depth == 1:
+        return int.bit_count(moves)
+
+    leaves = 0
+    while moves:
+        move = moves & -moves
+        moves ^= move
+
+        new_player, new_opponent = update(move.bit_length() - 1, player, opponent)
+        leaves += perft(new_opponent, new_player, depth - 1, False, gen_moves, update)
+
+    return leaves
+
+def perft_state(state, depth, **kwargs):
+    # perft from any GameState
+    return perft(state.player, state.opponent, depth, **kwargs)
+
+def divide(state, depth):
+    """
+    Leaf counts split by the first move, for tracking down which move a wrong count comes from.
+    :return: {move name: leaves}
+    """
+    return {o.move_name(move): perft_state(child, depth - 1) if depth > 1 else 1 for move, child in state.children()}
+
+def benchmark(depth, state=None, **kwargs):
+    """
+    Time one perft run.
+    :param state: GameState to start from, the start position if None
+    :return: leaves, seconds, leaves per second
+    """
+    state = GameState() if state is None else state
+
+    start = time.perf_counter()
+    leaves = perft_state(state, depth, **kwargs)
+    seconds = time.perf_counter() - start
+
+    return leaves, seconds, leaves / seconds if seconds > 0 else 0
+
+def check_start_position(max_depth=8, verbose=True):
+    """
+    Run perft from the start position for every depth up to max_depth and compare against START_PERFT.
+    :return: Total leaves per second over all depths. Raises AssertionError on the first wrong count.
+    """
+    total_leaves, total_seconds = 0, 0
+    for depth in range(1, max_depth + 1):
+        leaves, seconds, rate = benchmark(depth)
+        assert leaves == START_PERFT[depth], f'perft({depth}) = {leaves}, expected {START_PERFT[depth]}'
+
+        total_leaves += leaves
+        total_seconds += seconds
+        if verbose:
+            print(f'perft({depth}) = {leaves:>12}  {seconds:8.3f}s  {rate:12,.0f} leaves/s')
+
+    return total_leaves / total_seconds if total_seconds > 0 else 0
+
+def compare_with_naive(num_positions=200, depth=3, seed=None):
+    """
+    perft from positions along random games, with the bitboard functions and with the original
+    naive_gen_moves + naive_update_board. Covers midgame and endgame positions, passes included.
+    :return: Number of positions compared. Raises AssertionError on the first mismatch.
+    """
+    rng = random.Random(seed)
+
+    compared = 0
+    while compared < num_positions:
+        state = GameState()
+        while not state.is_terminal() and compared < num_positions:
+            expected = perft_state(state, depth, gen_moves=o.naive_gen_moves, update=o.naive_update_board)
+            assert perft_state(state, depth) == expected, f'perft mismatch at {state}'
+            compared += 1
+
+            for _ in range(rng.randint(1, 6)): # Skip ahead a few random moves
+                if state.is_terminal():
+                    break
+                state = state.play(o.random_bit(state.moves, rng) if state.moves else -1)
+
+    return compared
+
+
+if __name__ == '__main__':
+    print('Start position:')
+    rate = check_start_position(8)
+    print(f'All counts match, {rate:,.0f} leaves/s overall\n')
+
+    # Baseline for comparing against future changes: the original square-walking functions on the same tree
+    leaves, seconds, naive_rate = benchmark(6, gen_moves=o.naive_gen_moves, update=o.naive_update_board)
+    print(f'Naive functions, perft(6): {seconds:.3f}s  {naive_rate:,.0f} leaves/s')
+    leaves, seconds, fast_rate = benchmark(6)
+    print(f'Bitboard functions, perft(6): {seconds:.3f}s  {fast_rate:,.0f} leaves/s ({fast_rate / naive_rate:.1f}x)\n')
+
+    print(f'Bitboard and naive perft agree on {compare_with_naive(seed=0)} positions from random games')
+
+    rng = random.Random(0)
+    state = GameState()
+    while state.turn_count < 40:
+        state = state.play(o.random_bit(state.moves, rng) if state.moves else -1)
+    print('\nDivide, depth 5 at turn 40 of a random game:')
+    o.disp_game(state.white, state.black, state.black_to_play)
+    for name, leaves in divide(state, 5).items():
+        print(f'{name}: {leaves}')
@@ -1,14 +1,19 @@
-import random
 import torch
+import multiprocessing
 import Othello
 import MonteCarlo as mc
+import TreeMemory as tm
 from NeuralMonteCarlo import NeuralMonteCarlo
 from GUI import Display
 from AlphaZeroNetwork import AlphaZeroNet
+from TranspositionTable import TranspositionTable
+from EvaluationCache import EvaluationCache
+from Endgame import EndgameSolver
+from GameState import GameState
+from TimeControl import TimeManager
 
 def convert_move_to_index(move):
-    square = list(move.upper())
-    return 8 * (int(square[1]) - 1) + ord(square[0]) - 65
+    return Othello.SQUARE_INDEX[move.upper()]
 
 def det_turn(turn, color):
     match color:
@@ -20,131 +25,243 @@ def det_turn(turn, color):
             else: return True
         case _: raise Exception('Invalid Player Color')
 
-def update_node(node, move):
+def update_node(node, move, table=None, array_tree=False):
     '''
     Update Node will create a root Node if not already created. Then it will check if
        the move given was already explored: if it was it will return that node
-       along with the move, otherwise it will create a new child node.
+       along with the move, otherwise it will create a new child node. The new root is cut off from
+       the old tree (TreeMemory.detach), so the rest of it can be freed.
     :param node: Node that needs to be updated
     :param move: Game Move
+    :param table: TranspositionTable for a newly created root
+    :param array_tree: Create the new root in an ArrayTree instead of as a Board.Node
     :return: root, move
     '''
 
     if node is None:
-        node = mc.create_root()
+        node = mc.create_root(table, array_tree)
 
     if move not in [child.move for child in node.children]:
         root = node.make_child(move)
     else:
         root = next(child for child in node.children if child.move == move)
 
-    return root
+    return tm.detach(root)
 
 class Player:
-    def __init__(self, player_type, board, game_param, second):
+    def __init__(self, player_type, game_param, second):
         self.player_type = player_type
-        self.board = board
         self.root = None
+        self.pool = None # Worker processes of a parallel 'carlo' search
+        self.search = None # NeuralMonteCarlo kept over the game, following every move (see follow_move)
+
+        prefix = 'secondary' if second else 'primary'
+
+        table_size = game_param[f'{prefix}_table_size']
+        self.table = TranspositionTable(table_size) if table_size else None
+        self.tree_table = self.table if player_type == 'carlo' else None # Only carlo searches the Board.Node tree
+        self.array_tree = player_type == 'carlo' and game_param[f'{prefix}_carlo_array_tree']
+
+        self.solver = EndgameSolver(game_param[f'{prefix}_endgame_empties'], game_param[f'{prefix}_endgame_root_empties'])
+        self.max_nodes = game_param[f'{prefix}_max_nodes']
+        self.report_memory = game_param['report_memory']
+
+        # Game clock for the searches. Without one, they run their fixed iteration counts.
+        game_time = game_param[f'{prefix}_time_per_game']
+        self.clock = TimeManager(game_time, game_param[f'{prefix}_time_increment']) if game_time else None
 
         match player_type:
             case 'carlo':
                 if not second:
                     self.carlo_iterations = game_param['primary_carlo_iterations']
                     self.C = game_param['primary_C']
+                    self.carlo_playouts = game_param['primary_carlo_playouts']
+                    self.carlo_workers = game_param['primary_carlo_workers']
+                    self.carlo_parallel = game_param['primary_carlo_parallel']
                 else:
                     self.carlo_iterations = game_param['secondary_carlo_iterations']
                     self.C = game_param['secondary_C']
+                    self.carlo_playouts = game_param['secondary_carlo_playouts']
+                    self.carlo_workers = game_param['secondary_carlo_workers']
+                    self.carlo_parallel = game_param['secondary_carlo_parallel']
+
+                # One pool for the whole game, so no move pays for starting processes inside its time budget
+                self.pool = multiprocessing.Pool(self.carlo_workers) if self.carlo_workers > 1 else None
             case 'neural':
                 if not second:
                     self.network = game_param['primary_network']
                     self.network_iterations = game_param['primary_network_iterations']
+                    self.network_batch_size = game_param['primary_network_batch_size']
+                    cache_size, symmetric = game_param['primary_cache_size'], game_param['primary_cache_symmetric']
                 else:
                     self.network = game_param['secondary_network']
                     self.network_iterations = game_param['secondary_network_iterations']
+                    self.network_batch_size = game_param['secondary_network_batch_size']
+                    cache_size, symmetric = game_param['secondary_cache_size'], game_param['secondary_cache_symmetric']
+                self.cache = EvaluationCache(cache_size, symmetric) if cache_size else None
 
-    def get_move(self, player_2, turn, display):
-        valid_moves = Othello.get_valid_move_list(self.board, player_2.board)
-        if len(valid_moves) == 0:
-            self.root = update_node(self.root, -1)
-            player_2.root = update_node(player_2.root, -1)
+    def get_move(self, player_2, state, display):
+        valid_moves = state.moves
+        if valid_moves == 0:
+            self.follow_move(-1)
+            player_2.follow_move(-1)
             return -1
 
+        time_limit = self.clock.start_move(state) if self.clock is not None else None
+
         match self.player_type:
             case 'carlo':
-                self.root, move = mc.monte_carlo_tree_search(self.root, self.carlo_iterations, self.C)
+                iterations = self.carlo_iterations if time_limit is None else None
+                self.root, move = mc.monte_carlo_tree_search(self.root, iterations, self.C, self.carlo_playouts,
+                                                             self.table, self.solver, self.array_tree, self.carlo_workers,
+                                                             self.carlo_parallel, self.pool, time_limit=time_limit,
+                                                             max_nodes=self.max_nodes)
             case 'player':
                 move = display.ask_user_input(valid_moves)
-                self.root = update_node(self.root, move)
+                self.root = update_node(self.root, move, self.tree_table, self.array_tree)
             case 'neural':
-                if not turn % 2: mcts = NeuralMonteCarlo(self.network, player_2.board, self.board, turn)
-                else: mcts = NeuralMonteCarlo(self.network, self.board, player_2.board, turn)
+                if self.search is None or self.search.root.state != state:
+                    self.search = NeuralMonteCarlo(self.network, state, table=self.table, solver=self.solver,
+                                                   max_nodes=self.max_nodes, batch_size=self.network_batch_size,
+                                                   cache=self.cache)
+                mcts = self.search
+                searched = mcts.root
 
-                mcts.run_iterations(self.network_iterations)
+                # The root keeps the visits of the earlier searches that led here, only the rest is searched
+                if time_limit is None:
+                    mcts.top_up(self.network_iterations)
+                else:
+                    mcts.run(time_limit=time_limit)
                 move = mcts.get_move_to_play()
 
-                self.root = update_node(self.root, move)
+                self.follow_move(move)
             case 'random':
-                move = random.choice(valid_moves)
-                self.root = update_node(self.root, move)
+                move = Othello.random_bit(valid_moves)
+                self.root = update_node(self.root, move, self.tree_table, self.array_tree)
             case _: raise Exception("Invalid Player Type!")
 
-        player_2.root = update_node(player_2.root, move)
+        if self.clock is not None:
+            self.clock.end_move()
+
+        if self.report_memory and self.player_type in ('carlo', 'neural'):
+            # The tree just searched: carlo's root has moved on to the chosen child
+            self.print_memory(searched if self.player_type == 'neural' else self.root.parent or self.root)
+
+        player_2.follow_move(move)
         return move
 
+    def follow_move(self, move):
+        # Play move, by either player, in this player's search trees
+        self.root = update_node(self.root, move, self.tree_table, self.array_tree)
+        if self.search is not None:
+            self.search.advance(move)
+
+
+    def close(self):
+        # End of the game: stop the worker processes
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def print_memory(self, root):
+        report = tm.memory_report(root)
+        peak = report['peak_process_bytes']
+        print(f'{self.player_type}: {report["nodes"]} nodes, {report["tree_bytes"] / 2 ** 20:.1f} MB in the tree'
+              + (f', {peak / 2 ** 20:.0f} MB peak process memory' if peak is not None else ''))
+
 
 def game(P1, P2, game_param):
-    black = Player(P1, 68853694464, game_param, False)
-    white = Player(P2, 34628173824, game_param, True)
+    players = []
+    try:
+        black = Player(P1, game_param, False)
+        players.append(black)
+        white = Player(P2, game_param, True)
+        players.append(white)
+        return play_game(black, white)
+    finally:
+        for player in players:
+            player.close()
 
+def play_game(black, white):
     game_code = ''
-    turn = 0
+    state = GameState()
     last_turn_pass = False
 
     display = Display(500,500)
-    display.setup_board([black.board, white.board])
+    display.setup_board([state.black, state.white])
 
     while True:
-        if not turn % 2: # Black's turn
-            display.set_board_display([black.board, white.board], turn % 2)
-            move = black.get_move(white, turn, display)
-        else: # White's turn
-            display.set_board_display([white.board, black.board], turn % 2)
-            move = white.get_move(black, turn, display)
+        display.set_board_display([state.player, state.opponent], state.turn_count % 2)
+        if state.black_to_play:
+            move = black.get_move(white, state, display)
+        else:
+            move = white.get_move(black, state, display)
 
         if move == -1:
             if last_turn_pass:
                 # Game is Complete!
-                return white.board, black.board, game_code
+                return state.white, state.black, game_code
             else:
                 last_turn_pass = True
         else:
-            if not turn % 2: black.board, white.board = Othello.update_board(move, black.board, white.board)
-            else: white.board, black.board = Othello.update_board(move, white.board, black.board)
             last_turn_pass = False
-        game_code += f' {chr(move % 8 + 65)}{move // 8 + 1}'
+        game_code += f' {Othello.move_name(move)}'
 
-        turn += 1
+        state = state.play(move)
 
+# Inference mode: BatchNorm uses its stored statistics, so an evaluation does not depend on the rest of its batch
 net_1 = AlphaZeroNet()
 net_1.load_state_dict(torch.load('Models/zero.pt'))
+net_1.eval()
 
 net_2 = AlphaZeroNet()
 net_2.load_state_dict(torch.load('Models/zero.pt'))
+net_2.eval()
 
 game_params = {
     # Player 1
     'primary_carlo_iterations': 100,
     'primary_C': 2**.5,
+    'primary_carlo_playouts': 1, # Random games per simulated leaf
+    'primary_carlo_array_tree': False, # Keep the search tree in NumPy arrays (ArrayTree) instead of Node objects
+    'primary_carlo_workers': 1, # Processes to search with
+    'primary_carlo_parallel': 'root', # 'root': every worker runs all the iterations, results merged at the root
+                                      # 'leaf': one shared tree, the workers run its rollouts (Node trees only)
+    'primary_table_size': 100000, # Transposition table entries, 0 to disable
+    'primary_endgame_empties': 8, # Solve leaves with this many empty squares or fewer
+    'primary_endgame_root_empties': 12, # Play perfectly from this many empty squares on
+    'primary_time_per_game': None, # Milliseconds for all of the player's moves, None to use the iteration counts instead
+    'primary_time_increment': 0, # Milliseconds added to the clock after every move
+    'primary_max_nodes': None, # Node budget for the search tree, low-visit subtrees are pruned past it. None for no limit.
 
-    'primary_network': net_1,
+    'primary_network': net_1, # AlphaZeroNet, or an InferenceClient of a running InferenceServer (InferenceServer.py)
     'primary_network_iterations': 100,
+    'primary_network_batch_size': 8, # Leaves evaluated per forward pass, 1 to evaluate them one at a time
+    'primary_cache_size': 100000, # Network outputs kept between searches (EvaluationCache), 0 to disable
+    'primary_cache_symmetric': False, # Share cache entries between the 8 symmetric versions of a position
 
     # Player 2
     'secondary_carlo_iterations': 50,
     'secondary_C': 2 ** .5,
+    'secondary_carlo_playouts': 1,
+    'secondary_carlo_array_tree': False,
+    'secondary_carlo_workers': 1,
+    'secondary_carlo_parallel': 'root',
+    'secondary_table_size': 100000,
+    'secondary_endgame_empties': 8,
+    'secondary_endgame_root_empties': 12,
+    'secondary_time_per_game': None,
+    'secondary_time_increment': 0,
+    'secondary_max_nodes': None,
 
     'secondary_network': net_2,
-    'secondary_network_iterations': 100
+    'secondary_network_iterations': 100,
+    'secondary_network_batch_size': 8,
+    'secondary_cache_size': 100000,
+    'secondary_cache_symmetric': False,
+
+    'report_memory': False # Print the size of the search tree after every search
 }
 
 '''
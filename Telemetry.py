@@ -0,0 +1,169 @@
+import json
+import time
+import TreeMemory as tm
+from ArrayTree import ArrayNode
+
+"""
+Optional instrumentation for MonteCarlo and NeuralMonteCarlo. Pass a Telemetry object as `telemetry` to
+monte_carlo_tree_search or NeuralMonteCarlo and the search fills it in: time per phase, iterations per second,
+depth of the new leaves, branching factor, tree size and network calls. It keeps adding up over several
+searches (e.g. every move of a game), so one object can cover a whole game or self-play run.
+
+Without one (telemetry=None, the default) the searches only test for None at each phase boundary.
+"""
+
+
+class Telemetry:
+
+    def __init__(self):
+        self.phase_seconds = {} # Phase name -> seconds, in the order the phases first ran
+        self.searches = 0
+        self.iterations = 0
+        self.seconds = 0 # Wall time of all searches, overhead between the phases included
+
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.branching_sum = 0 # Legal moves (1 for a pass) of every expanded node
+
+        self.network_calls = 0
+        self.network_positions = 0 # Positions evaluated, more than the calls once evaluations are batched
+
+        self.tree_nodes = 0 # Size of the tree after the last search
+        self.tree_bytes = 0
+        self.max_tree_nodes = 0
+
+        self.search_start = None
+        self.lap_start = None
+        self.nested_seconds = 0 # Time inside the current phase that another phase (inference) already counted
+
+    def begin(self):
+        # Start of a search
+        self.search_start = time.perf_counter()
+
+    def end(self, root, iterations=None):
+        """
+        End of a search.
+        :param root: Root of the searched tree, for its size
+        :param iterations: Iterations run, for searches that do not report every leaf (the parallel ones)
+        """
+        self.seconds += time.perf_counter() - self.search_start
+        self.searches += 1
+        if iterations is not None:
+            self.iterations += iterations
+
+        if isinstance(root, ArrayNode):
+            self.tree_nodes, self.tree_bytes = root.tree.node_count(), root.tree.memory_usage()
+        else:
+            # Estimated from the root's size, so this stays one pass over the tree (see TreeMemory.memory_report)
+            self.tree_nodes = tm.count_nodes(root)
+            self.tree_bytes = self.tree_nodes * tm.node_size(root)
+        self.max_tree_nodes = max(self.max_tree_nodes, self.tree_nodes)
+
+    def start(self):
+        # Start of an iteration
+        self.lap_start = time.perf_counter()
+        self.nested_seconds = 0
+
+    def lap(self, phase):
+        # End of a phase: the time since the last lap goes to phase
+        now = time.perf_counter()
+        self.add_time(phase, now - self.lap_start - self.nested_seconds)
+        self.lap_start = now
+        self.nested_seconds = 0
+
+    def add_time(self, phase, seconds):
+        self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + seconds
+
+    def leaf(self, depth, branching):
+        """
+        One finished iteration.
+        :param depth: Depth of the new leaf below the root
+        :param branching: Legal moves of the node it was expanded from (1 for a pass)
+        """
+        self.iterations += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.branching_sum += branching
+
+    def instrument(self, network):
+        # Network wrapper that counts its calls and times them as the 'inference' phase
+        return InstrumentedNetwork(network, self)
+
+    def summary(self):
+        # Everything recorded so far as a dict of plain numbers (what to_json writes)
+        phase_total = sum(self.phase_seconds.values())
+        leaves = max(1, self.iterations)
+        return {
+            'searches': self.searches,
+            'iterations': self.iterations,
+            'seconds': self.seconds,
+            'iterations_per_second': self.iterations / self.seconds if self.seconds > 0 else 0,
+            'phase_seconds': dict(self.phase_seconds),
+            'phase_fractions': {phase: seconds / phase_total for phase, seconds in self.phase_seconds.items()}
+                               if phase_total > 0 else {},
+            'mean_depth': self.depth_sum / leaves,
+            'max_depth': self.max_depth,
+            'mean_branching_factor': self.branching_sum / leaves,
+            'tree_nodes': self.tree_nodes,
+            'tree_bytes': self.tree_bytes,
+            'max_tree_nodes': self.max_tree_nodes,
+            'network_calls': self.network_calls,
+            'network_positions': self.network_positions,
+        }
+
+    def to_json(self, path=None):
+        """
+        :param path: File to write the summary to, or None
+        :return: The summary as a JSON string
+        """
+        text = json.dumps(self.summary(), indent=4)
+        if path is not None:
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(text)
+        return text
+
+
+class InstrumentedNetwork:
+    # Stands in for the network in NeuralMonteCarlo while a Telemetry object is recording
+
+    def __init__(self, network, telemetry):
+        self.network = network
+        self.telemetry = telemetry
+
+    def __call__(self, x):
+        start = time.perf_counter()
+        result = self.network(x)
+        seconds = time.perf_counter() - start
+
+        telemetry = self.telemetry
+        telemetry.network_calls += 1
+        telemetry.network_positions += len(x)
+        telemetry.add_time('inference', seconds)
+        telemetry.nested_seconds += seconds
+        return result
+
+
+def node_depth(node, root):
+    # Edges from root down to node
+    depth = 0
+    while node is not root and node.parent is not None:
+        node = node.parent
+        depth += 1
+    return depth
+
+
+if __name__ == '__main__':
+    import torch
+    import MonteCarlo as mc
+    from Endgame import EndgameSolver
+    from NeuralMonteCarlo import NeuralMonteCarlo
+    from AlphaZeroNetwork import AlphaZeroNet
+
+    telemetry = Telemetry()
+    mc.monte_carlo_tree_search(None, 2000, 2 ** .5, 1, None, EndgameSolver(0, 0), progress=False, telemetry=telemetry)
+    print('MonteCarlo:', telemetry.to_json())
+
+    telemetry = Telemetry()
+    with torch.no_grad():
+        NeuralMonteCarlo(AlphaZeroNet().eval(), telemetry=telemetry).run_iterations(200)
+    print('NeuralMonteCarlo:', telemetry.to_json())
@@ -0,0 +1,119 @@
+import time
+
+"""
+Search budgets for MonteCarlo and NeuralMonteCarlo, and a time manager that splits a game clock over the moves.
+Times are in milliseconds.
+"""
+
+# How often (in iterations) the searches check whether the best move is already decided
+DECIDED_CHECK_EVERY = 16
+
+
+class SearchBudget:
+
+    def __init__(self, iterations=None, time_limit=None, stop=None):
+        """
+        The search ends at whichever limit comes first. At least one has to be given.
+        :param iterations: Maximum number of iterations, None for no limit
+        :param time_limit: Milliseconds to search for, None for no limit
+        :param stop: threading.Event. The search ends as soon as it is set, e.g. by another thread.
+        """
+        if iterations is None and time_limit is None and stop is None:
+            raise ValueError('SearchBudget needs iterations, a time_limit or a stop event, otherwise it never ends')
+
+        self.iterations = iterations
+        self.stop = stop
+
+        self.start = time.perf_counter()
+        self.deadline = self.start + time_limit / 1000 if time_limit is not None else None
+
+        self.done = 0 # Iterations completed so far
+
+    def tick(self, count=1):
+        self.done += count
+
+    def elapsed(self):
+        # Milliseconds since the budget was created
+        return (time.perf_counter() - self.start) * 1000
+
+    def exhausted(self):
+        if self.iterations is not None and self.done >= self.iterations:
+            return True
+        if self.stop is not None and self.stop.is_set():
+            return True
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def timed(self):
+        # True if the search can end before its iteration limit: a deadline or a stop signal
+        return self.deadline is not None or self.stop is not None
+
+    def remaining(self):
+        """
+        Estimate of the iterations still to come: what is left of the iteration limit, and what fits before
+        the deadline at the speed so far. Infinite if neither limit is set (stop signal only).
+        """
+        remaining = float('inf')
+        if self.iterations is not None:
+            remaining = self.iterations - self.done
+
+        if self.deadline is not None:
+            now = time.perf_counter()
+            rate = self.done / (now - self.start) if now > self.start else float('inf')
+            remaining = min(remaining, rate * max(0, self.deadline - now))
+
+        return remaining
+
+    def decided(self, visits):
+        """
+        :param visits: Visit counts of every move at the root, 0 for moves without a child yet
+        :return: True if the most visited move can no longer be overtaken, even if every remaining
+            iteration went to the runner-up. Always True with a single move.
+        """
+        if len(visits) < 2:
+            return True
+
+        first, second = sorted(visits, reverse=True)[:2]
+        return first - second > self.remaining()
+
+
+class TimeManager:
+    """
+    Splits a total game clock (per player) across the moves. Every move gets an equal share of the time left
+    over the moves the player is still expected to make, plus the increment, and never more than the clock
+    minus a safety margin.
+    """
+
+    def __init__(self, total_time, increment=0, safety_margin=50, min_time=10):
+        """
+        :param total_time: Milliseconds for the whole game
+        :param increment: Milliseconds added to the clock after every move
+        :param safety_margin: Milliseconds always kept back for the overhead around the search
+        :param min_time: Smallest budget handed out for a move
+        """
+        self.time_left = total_time
+        self.increment = increment
+        self.safety_margin = safety_margin
+        self.min_time = min_time
+
+        self.move_start = None
+
+    def moves_left(self, state):
+        # Moves still to make for the side to move: half of the empty squares, rounded up
+        return max(1, (state.empties + 1) // 2)
+
+    def budget(self, state):
+        # Milliseconds to spend on the move from state
+        share = self.time_left / self.moves_left(state) + self.increment
+        return max(self.min_time, min(share, self.time_left - self.safety_margin))
+
+    def start_move(self, state):
+        # Start the clock for a move. Returns its budget in milliseconds.
+        self.move_start = time.perf_counter()
+        return self.budget(state)
+
+    def end_move(self):
+        # Stop the clock: charge the time actually used and add the increment
+        used = (time.perf_counter() - self.move_start) * 1000
+        self.time_left += self.increment - used
+        self.move_start = None
+        return used
@@ -1,9 +1,17 @@
 import Othello as o
+import copy
 import random
 import math
+import queue
+import traceback
 import torch
+import torch.multiprocessing as mp
+import TreeMemory as tm
 from AlphaZeroNetwork import AlphaZeroNet
-from NeuralMonteCarlo import board_state_to_tensor, NeuralMonteCarlo
+from NeuralMonteCarlo import board_state_to_tensor, evaluate_states, NeuralMonteCarlo
+from Endgame import EndgameSolver
+from EvaluationCache import EvaluationCache
+from GameState import GameState
 from tqdm import tqdm
 import json
 from torch.utils.data import Dataset
@@ -13,31 +21,32 @@ Goal: Generate a bunch of training data from an AlphaZero-style network trying t
 play Othello.
 """
 
-def generate_game_data(network, mcts_its_per_turn=100):
+def generate_game_data(network, mcts_its_per_turn=100, max_nodes=None, batch_size=8, cache=None):
     network = network.eval()
     with torch.no_grad():
         # Initalize board state
-        white = 34628173824
-        black = 68853694464
-        turn_count = 0
+        state = GameState()
         pass_last_turn = False
 
         data = []
+        solver = EndgameSolver() # One per game, so its hash table carries over between moves
+
+        # One search for the whole game. After every move its root moves on to the chosen child (advance), so the
+        # search under it is reused.
+        # batch_size leaves are evaluated per forward pass, positions already in the cache are not evaluated again
+        mcts = NeuralMonteCarlo(network, state, solver=solver, max_nodes=max_nodes, batch_size=batch_size, cache=cache)
 
         # Loop through the game's logic until it is over.
         while True:
-            turn = turn_count % 2 == 0
-
             # Evaluate MCTS for the current move -> Generates a policy probability distribution.
             # This distribution is stored as a dictionary.
-            mcts = NeuralMonteCarlo(network, white, black, turn_count)
 
-            # Run mcts_its_per_turn simulations on the tree.
-            mcts.run_iterations(mcts_its_per_turn)
+            # Search until the root has mcts_its_per_turn visits, the ones from the previous move included.
+            mcts.top_up(mcts_its_per_turn)
 
             # Add policy distribution and game state into data.
             dist = mcts.get_root_visit_distribution()
-            data.append([white, black, turn_count, dist])
+            data.append([state.white, state.black, state.turn_count, dist])
 
             move = mcts.get_move_to_play()
 
@@ -50,28 +59,118 @@ def generate_game_data(network, mcts_its_per_turn=100):
             else:
                 pass_last_turn = False
 
-                # If we don't pass, play that move
-                if turn:
-                    black, white = o.update_board(move, black, white)
-                else:
-                    white, black = o.update_board(move, white, black)
+            state = state.play(move)
+            mcts.advance(move)
+
+        return add_game_result(data, state)
+
+def add_game_result(data, state):
+    """
+    Now that the game is over, determine winner and add the winner in each data entry.
+    :param data: [white, black, turn_count, dist] of every move of the game
+    :param state: Final GameState
+    :return: data, with the result for the player to move appended to every entry
+    """
+    value = -state.winner() # 1 if black won, -1 if white won
 
-            turn_count += 1
+    for i in range(len(data)):
+        turn = data[i][2]
 
-        # Now that the game is over, determine winner and add the winner in each data entry.
-        value = o.determine_winner(black, white) # 1 if black won, -1 if white won
+        # Decide whether the current player won
+        v = value
+        if not turn % 2 == 0:
+            v *= -1
 
-        for i in range(len(data)):
-            turn = data[i][2]
+        data[i].append(v)
 
-            # Decide whether the current player won
-            v = value
-            if not turn % 2 == 0:
-                v *= -1
+    return data
 
-            data[i].append(v)
+class SelfPlayGame:
+    """
+    One game of lockstep self-play (generate_lockstep_games). Same game as generate_game_data, but its search is
+    driven from outside one batch of leaves at a time, so the leaves of many games share a forward pass.
+    """
 
-        return data
+    def __init__(self, network, mcts_its_per_turn=100, max_nodes=None, batch_size=8, cache=None):
+        self.state = GameState()
+        self.pass_last_turn = False
+        self.data = []
+
+        self.mcts_its_per_turn = mcts_its_per_turn
+        self.batch_size = batch_size
+        self.mcts = NeuralMonteCarlo(network, self.state, solver=EndgameSolver(), max_nodes=max_nodes,
+                                     batch_size=batch_size, cache=cache)
+        self.remaining = mcts_its_per_turn # Iterations left before the current move is played (see top_up)
+
+    def collect_leaves(self):
+        self.mcts.batch_size = min(self.batch_size, self.remaining)
+        return self.mcts.collect_leaves()
+
+    def expand_leaves(self, pending, evaluations):
+        self.remaining -= self.mcts.expand_leaves(pending, evaluations)
+
+    def play_move(self):
+        """
+        Play the move once its search is complete.
+        :return: True if the game is over
+        """
+        if self.remaining > 0:
+            return False
+
+        mcts = self.mcts
+        self.data.append([self.state.white, self.state.black, self.state.turn_count, mcts.get_root_visit_distribution()])
+
+        move = mcts.get_move_to_play()
+        if move == -1:
+            if self.pass_last_turn:
+                return True
+            self.pass_last_turn = True
+        else:
+            self.pass_last_turn = False
+
+        self.state = self.state.play(move)
+        mcts.advance(move)
+        self.remaining = max(1, self.mcts_its_per_turn - mcts.root.visits)
+        return False
+
+def generate_lockstep_games(network, num_games, parallel_games=16, mcts_its_per_turn=100, max_nodes=None,
+                            batch_size=8, cache=None, game_over=None):
+    """
+    Play num_games self-play games, parallel_games at a time in this process. Every step collects up to batch_size
+    leaves from each running game's search, evaluates all of them in one forward pass and plays the moves whose
+    search is complete. Finished games are replaced with new ones until num_games have been started.
+    :param game_over: Called with the records of every finished game
+    :return: Records of all the games, like generate_game_data
+    """
+    network = network.eval()
+    input_buffer = torch.empty((parallel_games * batch_size, 3, 8, 8))
+
+    data = []
+    games = []
+    started = 0
+    with torch.no_grad():
+        while games or started < num_games:
+            while len(games) < parallel_games and started < num_games:
+                games.append(SelfPlayGame(network, mcts_its_per_turn, max_nodes, batch_size, cache))
+                started += 1
+
+            pending = [game.collect_leaves() for game in games]
+            states = [state for leaves in pending for _, _, state, needed in leaves if needed]
+            evaluations = iter(evaluate_states(network, states, cache, input_buffer) if states else [])
+
+            running = []
+            for game, leaves in zip(games, pending):
+                game.expand_leaves(leaves, evaluations)
+                if game.play_move():
+                    records = add_game_result(game.data, game.state)
+                    data += records
+                    if game_over is not None:
+                        game_over(records)
+                else:
+                    running.append(game)
+            games = running
+
+    return data
 
 def add_to_buffer(buffer, games, max_buffer_size=100000):
     buffer = buffer + games
@@ -83,14 +182,139 @@ def add_to_buffer(buffer, games, max_buffer_size=100000):
 
     return buffer
 
-def add_games_to_buffer(buffer, network, num_games, max_buffer_size=100000, mcts_its_per_turn=100):
-    games = []
-    p_bar = tqdm(range(num_games), desc="Playing out Games")
-
-    for i in p_bar:
-        dat = generate_game_data(network, mcts_its_per_turn=mcts_its_per_turn)
+def shared_network(network):
+    """
+    The network's weights in shared memory, for worker processes to read without a copy each.
+    A network on the CPU is moved there in place, so the workers see it. Others are copied to the CPU first.
+    """
+    if any(parameter.device.type != 'cpu' for parameter in network.parameters()):
+        network = copy.deepcopy(network).cpu()
+    return network.eval().share_memory()
 
-        games = games + dat
+def self_play_worker(worker, network, num_games, seed, results, settings):
+    """
+    One process of pool_self_play. Plays num_games games and puts ('game', worker, records) on the results queue for
+    every finished game, then ('done', worker, None). A failure is sent back as ('error', worker, traceback).
+    """
+    mcts_its_per_turn, max_nodes, batch_size, parallel_games, cache_settings = settings
+    try:
+        torch.set_num_threads(1) # The workers already use one core each
+        random.seed(seed)
+        torch.manual_seed(seed)
+        cache = EvaluationCache(*cache_settings) if cache_settings is not None else None
+
+        def game_over(records):
+            results.put(('game', worker, records))
+
+        if parallel_games > 1:
+            generate_lockstep_games(network, num_games, parallel_games, mcts_its_per_turn, max_nodes, batch_size, cache,
+                                    game_over)
+        else:
+            for _ in range(num_games):
+                game_over(generate_game_data(network, mcts_its_per_turn, max_nodes, batch_size, cache))
+        results.put(('done', worker, None))
+    except Exception:
+        results.put(('error', worker, traceback.format_exc()))
+
+# Seconds pool_self_play waits for a result before checking that its workers are still alive
+RESULT_POLL_SECONDS = 1
+
+def pool_self_play(network, num_games, workers, mcts_its_per_turn=100, max_nodes=None, batch_size=8, parallel_games=1,
+                   cache_settings=None, game_over=None):
+    """
+    Play num_games self-play games in `workers` processes at once, all reading the same network from shared memory,
+    or all sending their positions to the same InferenceServer if network is an InferenceClient.
+    Every worker gets its own random seed and its share of the games, and sends every game back as soon as it is
+    finished, with a progress bar per worker.
+    :param parallel_games: Games each worker plays in lockstep (generate_lockstep_games), 1 to play them one by one
+    :param cache_settings: (max_size, symmetric) of the EvaluationCache every worker keeps, None for no cache
+    :param game_over: Called in this process with the records of every finished game
+    :return: Records of all the games
+    """
+    if isinstance(network, torch.nn.Module):
+        network = shared_network(network) # An InferenceClient instead is copied, every worker connects on its own
+    results = mp.Queue()
+    settings = (mcts_its_per_turn, max_nodes, batch_size, parallel_games, cache_settings)
+    seed = random.getrandbits(32)
+
+    shares = [num_games // workers + (k < num_games % workers) for k in range(workers)]
+    processes = {k: mp.Process(target=self_play_worker, args=(k, network, games, seed + k, results, settings),
+                               daemon=True) for k, games in enumerate(shares) if games > 0}
+    p_bars = [tqdm(total=games, desc=f"Worker {k}", position=k) for k, games in enumerate(shares)]
+
+    data = []
+    running = len(processes)
+    finished = set() # Workers that reported 'done'
+    for process in processes.values():
+        process.start()
+    try:
+        while running:
+            try:
+                kind, worker, payload = results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                # A worker killed from outside (signal, out of memory) never reports
+                for k, process in processes.items():
+                    if k not in finished and process.exitcode not in (None, 0):
+                        raise RuntimeError(f'Self-play worker {k} died with exit code {process.exitcode}')
+                continue
+
+            if kind == 'game':
+                data += payload
+                p_bars[worker].update()
+                if game_over is not None:
+                    game_over(payload)
+            elif kind == 'done':
+                finished.add(worker)
+                running -= 1
+            else:
+                raise RuntimeError(f'Self-play worker {worker} failed:\n{payload}')
+    finally:
+        for process in processes.values():
+            if running:
+                process.terminate()
+            process.join()
+        for p_bar in p_bars:
+            p_bar.close()
+
+    return data
+
+def add_games_to_buffer(buffer, network, num_games, max_buffer_size=100000, mcts_its_per_turn=100, max_nodes=None,
+                        batch_size=8, cache=None, parallel_games=1, workers=1):
+    # parallel_games: Games played at once in lockstep, sharing their forward passes (generate_lockstep_games)
+    # workers: Processes to play in (pool_self_play). Each keeps its own cache, with the same settings as cache.
+    if workers > 1:
+        def add_game(records):
+            nonlocal buffer
+            buffer = add_to_buffer(buffer, records, max_buffer_size=max_buffer_size)
+
+        cache_settings = (cache.max_size, cache.symmetric) if cache is not None else None
+        pool_self_play(network, num_games, workers, mcts_its_per_turn, max_nodes, batch_size, parallel_games,
+                       cache_settings, add_game)
+        return buffer
+
+    p_bar = tqdm(total=num_games, desc="Playing out Games")
+
+    def game_over(records):
+        postfix = {}
+        peak = tm.peak_memory()
+        if peak is not None:
+            postfix['Peak memory'] = f'{peak / 2 ** 20:.0f} MB'
+        if cache is not None:
+            postfix['Cache hits'] = f'{cache.hit_rate():.0%}'
+        p_bar.set_postfix(postfix)
+        p_bar.update()
+
+    if parallel_games > 1:
+        games = generate_lockstep_games(network, num_games, parallel_games, mcts_its_per_turn, max_nodes, batch_size,
+                                        cache, game_over)
+    else:
+        games = []
+        for i in range(num_games):
+            dat = generate_game_data(network, mcts_its_per_turn=mcts_its_per_turn, max_nodes=max_nodes,
+                                     batch_size=batch_size, cache=cache)
+            game_over(dat)
+            games = games + dat
+    p_bar.close()
 
     return add_to_buffer(buffer, games, max_buffer_size=max_buffer_size)
 
@@ -110,6 +334,9 @@ class PlayDataset(Dataset):
         if self.buffer is None:
             self.buffer = []
 
+        # Network outputs shared by all self-play games. It clears itself whenever the network has been trained.
+        self.cache = EvaluationCache()
+
     def __len__(self):
         return len(self.buffer)
 
@@ -133,8 +360,13 @@ class PlayDataset(Dataset):
 
         return state, policy, value
 
-    def play_games(self, network, num_games=60, mcts_its_per_turn=100):
-        self.buffer = add_games_to_buffer(self.buffer, network, num_games, self.max_buffer_size, mcts_its_per_turn)
+    def play_games(self, network, num_games=60, mcts_its_per_turn=100, max_nodes=None, batch_size=8, parallel_games=16,
+                   workers=1):
+        # max_nodes: Node budget of every search tree, batch_size: leaves per search and forward pass (see NeuralMonteCarlo)
+        # parallel_games: Games played at once, their leaves evaluated together (generate_lockstep_games)
+        # workers: Processes playing games at the same time (pool_self_play), each with parallel_games games
+        self.buffer = add_games_to_buffer(self.buffer, network, num_games, self.max_buffer_size, mcts_its_per_turn,
+                                          max_nodes, batch_size, self.cache, parallel_games, workers)
 
     def save_as(self, filepath):
         with open(filepath, 'w', encoding='utf-8') as file:
@@ -0,0 +1,66 @@
+"""
+Transposition table shared by the MonteCarlo (Board.Node) and NeuralMonteCarlo search trees.
+
+Othello reaches the same position through different move orders. Nodes for the same position
+(Othello.zobrist_hash, which includes the side to move) all point at the same Entry, so they share
+their visit / score statistics and the cached network evaluation instead of each building them up again.
+The trees keep their parent / move links, so every node still knows how it was reached.
+"""
+
+class Entry:
+    __slots__ = ('visits', 'score', 'evaluation')
+
+    def __init__(self):
+        self.visits = 0
+        self.score = 0
+        self.evaluation = None # NeuralMonteCarlo: (probabilities, value) from the network
+
+
+class TranspositionTable:
+
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.entries = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        Get the entry of a position, creating it if it is not stored yet.
+        When the table is full, the oldest entry is dropped. Nodes already holding it keep it,
+        it just stops being shared with new nodes.
+        :param key: Othello.zobrist_hash of the position
+        :return: Entry
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        if len(self.entries) >= self.max_size:
+            del self.entries[next(iter(self.entries))] # Dicts keep insertion order -> oldest first
+
+        entry = Entry()
+        self.entries[key] = entry
+        return entry
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def reset_statistics(self):
+        # Start a new search from scratch while keeping the cached network evaluations.
+        for entry in self.entries.values():
+            entry.visits = 0
+            entry.score = 0
+
+    def clear(self):
+        # Needed whenever the network weights change, since entries cache network outputs.
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
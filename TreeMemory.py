@@ -0,0 +1,140 @@
+import sys
+from ArrayTree import ArrayNode
+
+"""
+Keeping the search trees of MonteCarlo (Board.Node) and NeuralMonteCarlo (NeuralMonteCarlo.Node) bounded in
+memory over long games and long self-play runs:
+    - detach: cut the new root off from the old tree when the game moves on, so the old root and the siblings
+      of the played moves can be freed.
+    - prune: once a tree holds more than its node budget, collapse the subtrees under the least visited nodes.
+      Those nodes stay in the tree with their statistics and are expanded again if the search comes back to them.
+    - memory_report: node count and memory use, for logging.
+"""
+
+# prune cuts the tree down to this fraction of the budget, so it does not have to run again on the next iteration
+PRUNE_TARGET = 0.75
+
+
+def detach(node):
+    """
+    Make node the root of its own tree.
+    :return: The new root. Board / neural nodes just lose their parent link, an ArrayNode is copied out into a
+        compact ArrayTree of its own (see ArrayTree.subtree).
+    """
+    if isinstance(node, ArrayNode):
+        return ArrayNode(node.tree.subtree(node.index)) if node.index != 0 else node
+
+    node.parent = None
+    return node
+
+def iterate_nodes(root):
+    # Every node of the tree under root, root included, depth first
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.children)
+
+def count_nodes(root):
+    if isinstance(root, ArrayNode):
+        return root.tree.node_count()
+    return sum(1 for _ in iterate_nodes(root))
+
+def prune_threshold(root, target):
+    """
+    Smallest visit count such that clearing the children of every node below it leaves at most target nodes.
+    Visits only go down along a path (a node's visits include its children's), so the nodes that keep their
+    children are the ones at or above the threshold, and the tree keeps them plus their children.
+    :return: The threshold, 0 if the tree already fits
+    """
+    internal = sorted(((node.visits, len(node.children)) for node in iterate_nodes(root)
+                       if node is not root and node.children), reverse=True)
+
+    kept = 1 + len(root.children) # The root always keeps its children
+    for visits, children in internal:
+        kept += children
+        if kept > target:
+            return visits + 1
+    return 0
+
+def prune(root, max_nodes):
+    """
+    Cut the tree under root down to PRUNE_TARGET * max_nodes nodes by clearing the subtrees of the least visited
+    nodes. Only call it between iterations: a leaf still waiting for its result must not lose its path.
+    :return: The root of the pruned tree, a new one for an ArrayNode (see ArrayTree.prune), and its node count
+    """
+    target = int(PRUNE_TARGET * max_nodes)
+
+    if isinstance(root, ArrayNode):
+        tree = detach(root).tree.prune(target)
+        return ArrayNode(tree), tree.node_count()
+
+    threshold = prune_threshold(root, target)
+    if threshold == 0:
+        return root, count_nodes(root)
+
+    count = 1
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += len(node.children)
+        for child in node.children:
+            if child.visits < threshold:
+                child.clear_children()
+            else:
+                stack.append(child)
+
+    return root, count
+
+def node_size(node):
+    # Bytes held by one node object and what it owns alone (shared transposition entries are counted once per node)
+    size = sys.getsizeof(node) + sys.getsizeof(node.__dict__) + sys.getsizeof(node.stats) + sys.getsizeof(node.state)
+    for name in ('children', 'child_visits', 'child_scores', 'child_priors', 'edge_moves', 'probabilities'):
+        value = getattr(node, name, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+def peak_memory():
+    # Peak resident memory of this process in bytes, None where the resource module is missing (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # Bytes on macOS, kilobytes on Linux
+
+def memory_report(root):
+    """
+    :return: Dict with the node count of the tree under root, the bytes it holds (estimated from the object
+        sizes for node trees, the allocated arrays for an ArrayTree) and the peak memory of the process
+    """
+    if isinstance(root, ArrayNode):
+        nodes, tree_bytes = root.tree.node_count(), root.tree.memory_usage()
+    else:
+        nodes = tree_bytes = 0
+        for node in iterate_nodes(root):
+            nodes += 1
+            tree_bytes += node_size(node)
+
+    return {'nodes': nodes, 'tree_bytes': tree_bytes, 'bytes_per_node': tree_bytes / nodes,
+            'peak_process_bytes': peak_memory()}
+
+
+if __name__ == '__main__':
+    import MonteCarlo as mc
+    from Endgame import EndgameSolver
+
+    for array_tree in (False, True):
+        root = mc.create_root(array_tree=array_tree)
+        mc.monte_carlo_tree_search(root, 5000, 2 ** .5, 1, None, EndgameSolver(0, 0), progress=False, early_stop=False)
+
+        report = memory_report(root)
+        print(f'{"ArrayTree" if array_tree else "Board.Node"}: {report["nodes"]} nodes, '
+              f'{report["tree_bytes"] / 2 ** 20:.1f} MB ({report["bytes_per_node"]:.0f} bytes per node)')
+
+        root, nodes = prune(root, 2000)
+        print(f'Pruned to a budget of 2000: {nodes} nodes')
+
+    print(f'Peak process memory: {peak_memory() / 2 ** 20:.0f} MB')